@@ -5,4 +5,6 @@ apt-get install -y \
     qemu-utils \
     qemu-system-x86 \
     debootstrap \
-    kpartx
+    kpartx \
+    zstd \
+    xz-utils
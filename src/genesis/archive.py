@@ -0,0 +1,360 @@
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import subprocess
+import tempfile
+import urllib.parse
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+TIMEOUT = 60
+
+# provided by the ubuntu-keyring package
+DEFAULT_KEYRING = "/usr/share/keyrings/ubuntu-archive-keyring.gpg"
+
+# name, optional architecture qualifier (eg. ":any") and optional version constraint
+DEPENDENCY = re.compile(r"^\s*([a-z0-9][a-z0-9+.-]*)(?::[a-z0-9-]+)?\s*(?:\((.*)\))?\s*$")
+
+
+def fetch(url: str, session: requests.Session) -> bytes:
+    """
+    Fetch a resource from a mirror, file:// URLs are read directly.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        with open(urllib.parse.unquote(parsed.path), "rb") as f:
+            return f.read()
+
+    r = session.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.content
+
+
+def parse_control(content: str) -> Iterator[Dict[str, str]]:
+    """
+    Parse a deb822 file (Release, Packages...) and yield its stanzas.
+    """
+    stanza: Dict[str, str] = dict()
+    field: Optional[str] = None
+
+    for line in content.splitlines():
+        if line.strip() == "":
+            if stanza:
+                yield stanza
+            stanza = dict()
+            field = None
+        elif line[0] in " \t":
+            if field is not None:
+                stanza[field] += "\n" + line.strip()
+        else:
+            field, _, value = line.partition(":")
+            stanza[field] = value.strip()
+
+    if stanza:
+        yield stanza
+
+
+class Release:
+    """
+    The Release file of a suite, listing the checksums of the indices.
+    """
+
+    fields: Dict[str, str]
+    sha256: Dict[str, Tuple[str, int]]
+    hash: str
+
+    def __init__(self, content: bytes) -> None:
+        self.hash = hashlib.sha256(content).hexdigest()
+        self.fields = next(parse_control(content.decode()))
+        self.sha256 = dict()
+
+        for line in self.fields.get("SHA256", "").splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                checksum, size, path = parts
+                self.sha256[path] = (checksum, int(size))
+
+
+def dists_url(mirror: str, suite: str) -> str:
+    return f"{mirror.rstrip('/')}/dists/{suite}"
+
+
+def gpgv(keyring: str, arguments: List[str]) -> None:
+    if not os.path.exists(keyring):
+        raise RuntimeError(f"keyring {keyring} not found")
+
+    result = subprocess.run(
+        ["gpgv", "--keyring", os.path.abspath(keyring)] + arguments,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"signature verification failed: {result.stdout.decode().strip()}")
+
+
+def verify_inline(content: bytes, keyring: str) -> bytes:
+    """
+    Verify a clearsigned file (InRelease).
+    :return: the signed content, anything outside of the signature is dropped
+    """
+    with tempfile.TemporaryDirectory(prefix="genesis-gpgv") as tmp_dir:
+        signed = os.path.join(tmp_dir, "InRelease")
+        output = os.path.join(tmp_dir, "Release")
+        with open(signed, "wb") as f:
+            f.write(content)
+
+        gpgv(keyring, ["--output", output, signed])
+        with open(output, "rb") as f:
+            return f.read()
+
+
+def verify_detached(content: bytes, signature: bytes, keyring: str) -> None:
+    """
+    Verify a file and its detached signature (Release and Release.gpg).
+    """
+    with tempfile.TemporaryDirectory(prefix="genesis-gpgv") as tmp_dir:
+        data = os.path.join(tmp_dir, "Release")
+        sig = os.path.join(tmp_dir, "Release.gpg")
+        with open(data, "wb") as f:
+            f.write(content)
+        with open(sig, "wb") as f:
+            f.write(signature)
+
+        gpgv(keyring, [sig, data])
+
+
+def fetch_release(
+    mirror: str, suite: str, session: requests.Session, keyring: Optional[str]
+) -> Release:
+    """
+    Fetch the Release file of a suite and verify its signature.
+    :param keyring: the keyring to verify the signature with, if None the
+                    signature is not checked
+    """
+    url = dists_url(mirror, suite)
+    if keyring is None:
+        return Release(fetch(f"{url}/Release", session))
+
+    try:
+        return Release(verify_inline(fetch(f"{url}/InRelease", session), keyring))
+    except (requests.HTTPError, FileNotFoundError):
+        # older mirrors only have a detached signature
+        pass
+
+    content = fetch(f"{url}/Release", session)
+    verify_detached(content, fetch(f"{url}/Release.gpg", session), keyring)
+    return Release(content)
+
+
+def fetch_packages(
+    mirror: str,
+    suite: str,
+    component: str,
+    arch: str,
+    release: Release,
+    session: requests.Session,
+) -> str:
+    """
+    Fetch and verify a Packages index, preferring the compressed variants.
+    """
+    decompressors = {".xz": lzma.decompress, ".gz": gzip.decompress, "": lambda c: c}
+
+    for ext, decompress in decompressors.items():
+        path = f"{component}/binary-{arch}/Packages{ext}"
+        if path not in release.sha256:
+            continue
+
+        content = fetch(f"{dists_url(mirror, suite)}/{path}", session)
+        checksum, size = release.sha256[path]
+        if len(content) != size or hashlib.sha256(content).hexdigest() != checksum:
+            raise RuntimeError(f"{path} of {suite} does not match its Release checksum")
+
+        return decompress(content).decode()
+
+    raise RuntimeError(f"no Packages index for {component}/{arch} in {suite}")
+
+
+def order(c: str) -> int:
+    if c == "~":
+        return -1
+    if c.isdigit():
+        return 0
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def split_prefix(pattern: str, s: str) -> Tuple[str, str]:
+    match = re.match(pattern, s)
+    prefix = match.group(0) if match is not None else ""
+    return prefix, s[len(prefix) :]
+
+
+def compare_fragment(a: str, b: str) -> int:
+    """
+    Compare upstream versions or debian revisions, following the
+    algorithm described in deb-version(7).
+    """
+    while a or b:
+        a_str, a = split_prefix(r"[^0-9]*", a)
+        b_str, b = split_prefix(r"[^0-9]*", b)
+
+        for i in range(max(len(a_str), len(b_str))):
+            a_order = order(a_str[i]) if i < len(a_str) else 0
+            b_order = order(b_str[i]) if i < len(b_str) else 0
+            if a_order != b_order:
+                return a_order - b_order
+
+        a_num, a = split_prefix(r"[0-9]*", a)
+        b_num, b = split_prefix(r"[0-9]*", b)
+
+        if int(a_num or 0) != int(b_num or 0):
+            return int(a_num or 0) - int(b_num or 0)
+
+    return 0
+
+
+def split_version(version: str) -> Tuple[int, str, str]:
+    epoch = 0
+    if ":" in version:
+        epoch_str, version = version.split(":", 1)
+        epoch = int(epoch_str)
+
+    revision = ""
+    if "-" in version:
+        version, revision = version.rsplit("-", 1)
+
+    return epoch, version, revision
+
+
+def version_compare(a: str, b: str) -> int:
+    """
+    Compare two Debian versions.
+    :return: a negative number if a < b, 0 if they are equal, a positive number otherwise
+    """
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+
+    return compare_fragment(a_upstream, b_upstream) or compare_fragment(a_revision, b_revision)
+
+
+def parse_relations(field: str) -> List[List[str]]:
+    """
+    Parse a relation field (Depends, Pre-Depends...).
+    eg. "libc6 (>= 2.34), debconf | debconf-2.0"
+    gives [["libc6"], ["debconf", "debconf-2.0"]]
+    Version constraints and architecture qualifiers are dropped.
+    """
+    relations: List[List[str]] = list()
+    for relation in field.split(","):
+        if relation.strip() == "":
+            continue
+
+        alternatives: List[str] = list()
+        for alternative in relation.split("|"):
+            # drop build profiles and architecture restrictions
+            alternative = re.sub(r"[\[<].*?[\]>]", "", alternative)
+            match = DEPENDENCY.match(alternative)
+            if match is not None:
+                alternatives.append(match.group(1))
+
+        if alternatives:
+            relations.append(alternatives)
+
+    return relations
+
+
+class PackageIndex:
+    """
+    Packages available in a set of Packages indices. Only the highest version of
+    each package is kept.
+    """
+
+    packages: Dict[str, Dict[str, str]]
+    provides: Dict[str, List[str]]
+
+    def __init__(self) -> None:
+        self.packages = dict()
+        self.provides = dict()
+
+    def add_index(self, content: str) -> None:
+        for stanza in parse_control(content):
+            self.add(stanza)
+
+    def add(self, stanza: Dict[str, str]) -> None:
+        name = stanza["Package"]
+        current = self.packages.get(name)
+        if current is not None and version_compare(current["Version"], stanza["Version"]) >= 0:
+            return
+
+        self.packages[name] = stanza
+        for alternatives in parse_relations(stanza.get("Provides", "")):
+            providers = self.provides.setdefault(alternatives[0], list())
+            if name not in providers:
+                providers.append(name)
+
+    def find(self, name: str) -> Optional[str]:
+        """
+        Find the package to install to satisfy name (a real or virtual package).
+        """
+        if name in self.packages:
+            return name
+
+        providers = self.provides.get(name, list())
+        if providers:
+            return providers[0]
+
+        return None
+
+    def by_priority(self, priorities: List[str]) -> List[str]:
+        return [
+            name
+            for name, stanza in self.packages.items()
+            if stanza.get("Priority") in priorities or stanza.get("Essential") == "yes"
+        ]
+
+    def resolve(
+        self, names: List[str], recommends: bool = False
+    ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Compute the dependency closure of a list of packages.
+        :param names: the packages to install
+        :param recommends: also follow Recommends (as apt does by default),
+                           missing recommended packages are not errors
+        :return: the packages to install and the unsatisfiable relations
+                 (mapped to the package requiring them, "" for the requested ones)
+        """
+        selected: Dict[str, None] = dict()
+        missing: Dict[str, str] = dict()
+        queue: Deque[Tuple[List[str], str, bool]] = deque(([name], "", True) for name in names)
+
+        while queue:
+            alternatives, required_by, mandatory = queue.popleft()
+
+            if any(a in selected for a in alternatives):
+                continue
+
+            candidates = [self.find(a) for a in alternatives]
+            found = next((c for c in candidates if c is not None), None)
+            if found is None:
+                if mandatory:
+                    missing[" | ".join(alternatives)] = required_by
+                continue
+            if found in selected:
+                continue
+
+            selected[found] = None
+            stanza = self.packages[found]
+            fields = ["Pre-Depends", "Depends"] + (["Recommends"] if recommends else [])
+            for field in fields:
+                for relation in parse_relations(stanza.get(field, "")):
+                    queue.append((relation, found, field != "Recommends"))
+
+        return list(selected), missing
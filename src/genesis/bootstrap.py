@@ -0,0 +1,210 @@
+import hashlib
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from platform import machine
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import genesis.archive as archive
+import genesis.chroot as chroot
+import genesis.commands as commands
+
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64"}
+
+# packages unpacked and configured before the others, like debootstrap does
+CORE_PACKAGES = ["base-passwd", "base-files"]
+
+MERGED_USR_DIRECTORIES = ["bin", "sbin", "lib"]
+
+ARCHIVES_DIR = "var/cache/apt/archives"
+
+
+def host_architecture() -> str:
+    arch = machine()
+    if arch not in ARCHITECTURES:
+        raise ValueError(f"architecture {arch} not supported")
+
+    return ARCHITECTURES[arch]
+
+
+def create_session(workers: int) -> requests.Session:
+    """
+    Create a session whose connection pool can serve all the download workers.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def sha256sum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def download_deb(
+    mirror: str, stanza: Dict[str, str], archives_dir: str, session: requests.Session
+) -> str:
+    """
+    Download a package and verify its checksum.
+    :return: the path of the downloaded package
+    """
+    path = os.path.join(archives_dir, os.path.basename(stanza["Filename"]))
+    if os.path.exists(path) and sha256sum(path) == stanza["SHA256"]:
+        return path
+
+    content = archive.fetch(f"{mirror.rstrip('/')}/{stanza['Filename']}", session)
+    if hashlib.sha256(content).hexdigest() != stanza["SHA256"]:
+        raise RuntimeError(f"checksum mismatch for {stanza['Filename']}")
+
+    with open(path, "wb") as f:
+        f.write(content)
+
+    return path
+
+
+def extract_deb(deb: str, target: str) -> None:
+    """
+    Extract the data archive of a package (without registering it in the
+    dpkg database).
+    """
+    deb_proc = subprocess.Popen(["dpkg-deb", "--fsys-tarfile", deb], stdout=subprocess.PIPE)
+    tar_proc = subprocess.Popen(
+        ["tar", "-x", "-p", "--keep-directory-symlink", "-C", target], stdin=deb_proc.stdout
+    )
+    assert deb_proc.stdout is not None
+    deb_proc.stdout.close()
+    tar_proc.communicate()
+    deb_proc.wait()
+
+    if deb_proc.returncode != 0 or tar_proc.returncode != 0:
+        raise RuntimeError(f"failed to extract {deb}")
+
+
+def prepare_target(target: str, arch: str, mirror: str, series: str) -> None:
+    """
+    Create what dpkg and apt expect to find on the system before any package
+    is extracted.
+    """
+    os.makedirs(os.path.join(target, "usr"), exist_ok=True)
+
+    directories = MERGED_USR_DIRECTORIES + (["lib64"] if arch == "amd64" else [])
+    for directory in directories:
+        os.makedirs(os.path.join(target, "usr", directory), exist_ok=True)
+        link = os.path.join(target, directory)
+        if not os.path.lexists(link):
+            os.symlink(f"usr/{directory}", link)
+
+    for directory in ["var/lib/dpkg/info", "var/lib/dpkg/updates", "etc/apt", ARCHIVES_DIR]:
+        os.makedirs(os.path.join(target, directory), exist_ok=True)
+
+    for db in ["status", "available"]:
+        open(os.path.join(target, "var/lib/dpkg", db), "a").close()
+
+    with open(os.path.join(target, "var/lib/dpkg/arch"), "w") as f:
+        f.write(f"{arch}\n")
+
+    with open(os.path.join(target, "etc/apt/sources.list"), "w") as f:
+        f.write(f"deb {mirror} {series} main\n")
+
+    # don't start services while configuring packages
+    policy = os.path.join(target, "usr/sbin/policy-rc.d")
+    with open(policy, "w") as f:
+        f.write("#!/bin/sh\nexit 101\n")
+    os.chmod(policy, 0o755)
+
+
+def configure(target: str, core: List[str], debs: List[str]) -> None:
+    """
+    Register the extracted packages in the dpkg database and configure them
+    all at once.
+    """
+    # paths inside the chroot
+    core = [f"/{os.path.relpath(deb, target)}" for deb in core]
+    debs = [f"/{os.path.relpath(deb, target)}" for deb in debs]
+
+    env = {"DEBIAN_FRONTEND": "noninteractive", "PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}
+    dpkg = ["dpkg", "--force-depends", "--force-confold", "--force-unsafe-io"]
+
+    commands.run(["mount", "proc-live", "-t", "proc", f"{target}/proc"])
+    commands.run(["mount", "sysfs-live", "-t", "sysfs", f"{target}/sys"])
+    commands.run(["mount", "--bind", "/dev", f"{target}/dev"])
+
+    try:
+        with chroot.ChrootExecutor(target) as executor:
+            executor.run(
+                [
+                    chroot.RunCommand(dpkg + ["--install"] + core, env=env),
+                    chroot.RunCommand(dpkg + ["--unpack"] + debs, env=env),
+                    chroot.RunCommand(
+                        dpkg + ["--configure", "--pending", "--force-configure-any"], env=env
+                    ),
+                ]
+            )
+    finally:
+        commands.run(["umount", f"{target}/dev"])
+        commands.run(["umount", f"{target}/sys"])
+        commands.run(["umount", f"{target}/proc"])
+
+    os.remove(os.path.join(target, "usr/sbin/policy-rc.d"))
+
+
+def bootstrap(
+    series: str,
+    mirror: str,
+    target: str,
+    workers: int = 8,
+    keyring: Optional[str] = archive.DEFAULT_KEYRING,
+) -> None:
+    """
+    Build a root filesystem from the required and important packages of a
+    series, without debootstrap.
+    Packages are downloaded and extracted in parallel, then registered and
+    configured in one pass in the chroot.
+    :param series: the series to bootstrap
+    :param mirror: the mirror to download the packages from (http(s):// or file://)
+    :param target: where to build the root filesystem
+    :param workers: the number of packages downloaded/extracted in parallel
+    :param keyring: the keyring used to verify the Release file, if None the
+                    signature is not checked
+    """
+    arch = host_architecture()
+    session = create_session(workers)
+
+    release = archive.fetch_release(mirror, series, session, keyring)
+    index = archive.PackageIndex()
+    index.add_index(archive.fetch_packages(mirror, series, "main", arch, release, session))
+
+    packages, missing = index.resolve(index.by_priority(["required", "important"]))
+    if missing:
+        problems = ", ".join(f"{dep} (needed by {by})" for dep, by in missing.items())
+        raise RuntimeError(f"cannot bootstrap {series}, unsatisfiable dependencies: {problems}")
+
+    print(f"BOOTSTRAP {series} ({arch}): {len(packages)} packages from {mirror}")
+
+    prepare_target(target, arch, mirror, series)
+    archives_dir = os.path.join(target, ARCHIVES_DIR)
+
+    def fetch_and_extract(package: str) -> str:
+        deb = download_deb(mirror, index.packages[package], archives_dir, session)
+        extract_deb(deb, target)
+        return deb
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        debs = list(executor.map(fetch_and_extract, packages))
+
+    core = [deb for p, deb in zip(packages, debs) if p in CORE_PACKAGES]
+    others = [deb for deb in debs if deb not in core]
+    configure(target, core, others)
+
+    for deb in debs:
+        os.remove(deb)
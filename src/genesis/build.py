@@ -2,39 +2,105 @@ import os
 import sys
 import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from platform import processor
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import click
-import requests
 
+import genesis.archive as archive
+import genesis.bootstrap as bootstrap
+import genesis.chroot as chroot
 import genesis.commands as commands
+import genesis.compress as compress
+import genesis.config as config
 import genesis.disk_utils as disk_utils
+import genesis.http_cache as http_cache
+import genesis.image_inspect as image_inspect
+import genesis.overlay as overlay
+import genesis.preflight as preflight
+import genesis.telemetry as telemetry
+
+APT_ENV = {"DEBIAN_FRONTEND": "noninteractive"}
+
+# commands that don't touch loop devices, mounts or chroots
+UNPRIVILEGED_COMMANDS = ["preflight", "inspect"]
+
+
+def run_deboostrap(
+    series: str,
+    bootstrap_mirror: str,
+    build_dir_path: str,
+    engine: str = "debootstrap",
+    keyring: Optional[str] = None,
+    check_gpg: bool = True,
+) -> None:
+    """
+    :param keyring: the keyring used to verify the archive, defaults to the
+                    Ubuntu archive keyring
+    :param check_gpg: if False, the signature of the archive is not verified
+    """
+    if engine == "debootstrap":
+        options: List[str] = list()
+        if keyring is not None:
+            options.append(f"--keyring={keyring}")
+        if not check_gpg:
+            options.append("--no-check-gpg")
+        commands.run(
+            ["/usr/sbin/debootstrap"] + options + [series, build_dir_path, bootstrap_mirror]
+        )
+    elif engine == "native":
+        if not check_gpg:
+            print("WARN: the signature of the archive is not verified")
+            keyring = None
+        elif keyring is None:
+            keyring = archive.DEFAULT_KEYRING
+        bootstrap.bootstrap(series, bootstrap_mirror, build_dir_path, keyring=keyring)
+    else:
+        raise ValueError(f"bootstrap engine {engine} not supported")
+
+
+def apt_get(args: List[str]) -> chroot.RunCommand:
+    return chroot.RunCommand(["/usr/bin/apt-get"] + args, env=APT_ENV)
 
-SYSTEM_ROOT = os.open("/", os.O_RDONLY)
-CWD = os.getcwd()
 
+def installed_packages(root: str) -> Dict[str, int]:
+    """
+    Read the dpkg database of an image.
+    :param root: the root directory of the image
+    :return: the installed packages (as name:arch) and their Installed-Size in bytes
+    """
+    with open(f"{root}/var/lib/dpkg/status") as status_file:
+        status = status_file.read()
 
-def run_deboostrap(series: str, bootstrap_mirror: str, build_dir_path: str) -> None:
-    commands.run(["/usr/sbin/debootstrap", series, build_dir_path, bootstrap_mirror])
+    installed: Dict[str, int] = dict()
+    for stanza in archive.parse_control(status):
+        if not stanza.get("Status", "").endswith(" installed"):
+            continue
+        name = f"{stanza['Package']}:{stanza.get('Architecture', 'all')}"
+        # Installed-Size is in KiB
+        installed[name] = int(stanza.get("Installed-Size", "0")) * 1024
 
+    return installed
 
-def install_extra_packages(packages: List[str]):
-    os.environ["DEBIAN_FRONTEND"] = "noninteractive"
-    commands.run(["/usr/bin/apt-get", "update"])
-    commands.run(["/usr/bin/apt-get", "install", "-y"] + packages)
 
+def install_extra_packages(executor: chroot.ChrootExecutor, packages: List[str]):
+    executor.run([apt_get(["update"])])
 
-def do_system_update():
-    commands.run(["/usr/bin/apt-get", "update"])
-    commands.run(["/usr/bin/apt-get", "-y", "upgrade"])
+    install = apt_get(["install", "-y"] + packages)
+    if not telemetry.enabled():
+        executor.run([install])
+        return
 
+    # a single apt transaction, what each package costs is read from the
+    # dpkg database afterwards
+    before = installed_packages(executor.root)
+    executor.run([install])
+    telemetry.packages(before, installed_packages(executor.root), packages)
 
-def exit_chroot():
-    os.fchdir(SYSTEM_ROOT)
-    os.chroot(".")
 
-    os.chdir(CWD)
+def do_system_update() -> List[chroot.Operation]:
+    return [apt_get(["update"]), apt_get(["-y", "upgrade"])]
 
 
 def verify_root():
@@ -54,10 +120,8 @@ def mount_partition(rootfs_partition: str, mount_dir: str) -> None:
     commands.run(["mount", rootfs_partition, mount_dir])
 
 
-def add_fstab_entry(entry: str):
-    f = open("/etc/fstab", "a")
-    f.write(f"{entry}\n")
-    f.close()
+def add_fstab_entry(entry: str) -> chroot.WriteFile:
+    return chroot.WriteFile("/etc/fstab", f"{entry}\n".encode(), append=True)
 
 
 def umount_all(mount_dir: str):
@@ -68,47 +132,46 @@ def teardown_loop_device(device: str):
     commands.run(["losetup", "-d", f"/dev/{device}"])
 
 
-def divert_grub() -> None:
-    commands.run(
-        [
-            "dpkg-divert",
-            "--local",
-            "--divert",
-            "/etc/grub.d/30_os-prober.dpkg-divert",
-            "--rename",
-            "/etc/grub.d/30_os-prober",
-        ]
-    )
-
+def divert_grub() -> List[chroot.Operation]:
     detect_virt_tool = "/usr/bin/systemd-detect-virt"
-    commands.run(["dpkg-divert", "--local", "--rename", detect_virt_tool])
-
-    f = open(detect_virt_tool, "w")
-    f.write("exit 1\n")
-    f.close()
-
-    commands.run(["chmod", "+x", detect_virt_tool])
 
+    return [
+        chroot.RunCommand(
+            [
+                "dpkg-divert",
+                "--local",
+                "--divert",
+                "/etc/grub.d/30_os-prober.dpkg-divert",
+                "--rename",
+                "/etc/grub.d/30_os-prober",
+            ]
+        ),
+        chroot.RunCommand(["dpkg-divert", "--local", "--rename", detect_virt_tool]),
+        chroot.WriteFile(detect_virt_tool, b"exit 1\n", mode=0o755),
+    ]
 
-def undivert_grub() -> None:
-    commands.run(
-        [
-            "dpkg-divert",
-            "--remove",
-            "--local",
-            "--divert",
-            "/etc/grub.d/30_os-prober.dpkg-divert",
-            "--rename",
-            "/etc/grub.d/30_os-prober",
-        ]
-    )
 
+def undivert_grub() -> List[chroot.Operation]:
     detect_virt_tool = "/usr/bin/systemd-detect-virt"
-    os.remove(detect_virt_tool)
-    commands.run(["dpkg-divert", "--remove", "--local", "--rename", detect_virt_tool])
+
+    return [
+        chroot.RunCommand(
+            [
+                "dpkg-divert",
+                "--remove",
+                "--local",
+                "--divert",
+                "/etc/grub.d/30_os-prober.dpkg-divert",
+                "--rename",
+                "/etc/grub.d/30_os-prober",
+            ]
+        ),
+        chroot.Remove(detect_virt_tool),
+        chroot.RunCommand(["dpkg-divert", "--remove", "--local", "--rename", detect_virt_tool]),
+    ]
 
 
-def install_grub(device: str) -> None:
+def install_grub(executor: chroot.ChrootExecutor, device: str) -> None:
     """
     Install shim and grub and configure grub.
     This function will only work for amd64 and arm64.
@@ -116,52 +179,55 @@ def install_grub(device: str) -> None:
     packages = ["shim-signed"]
 
     # we only support legacy boot on x64
-    if processor() == 'x86_64':
+    if processor() == "x86_64":
         packages.append("grub-pc")
 
-    install_extra_packages(packages)
+    install_extra_packages(executor, packages)
 
-    efi_target = 'x86_64-efi'
+    efi_target = "x86_64-efi"
     if processor() == "aarch64":
-        efi_target = 'arm64-efi'
+        efi_target = "arm64-efi"
 
-    commands.run(
-        [
-            "grub-install",
-            device,
-            "--boot-directory=/boot",
-            "--efi-directory=/boot/efi",
-            f"--target={efi_target}",
-            "--uefi-secure-boot",
-            "--no-nvram",
-        ],
-        cwd="/",
-    )
+    operations: List[chroot.Operation] = [
+        chroot.RunCommand(
+            [
+                "grub-install",
+                device,
+                "--boot-directory=/boot",
+                "--efi-directory=/boot/efi",
+                f"--target={efi_target}",
+                "--uefi-secure-boot",
+                "--no-nvram",
+            ]
+        )
+    ]
 
-    if processor() == 'x86_64':
-        commands.run(["grub-install", "--target=i386-pc", device], cwd="/")
+    if processor() == "x86_64":
+        operations.append(chroot.RunCommand(["grub-install", "--target=i386-pc", device]))
 
-    divert_grub()
-    commands.run(["update-grub"], cwd="/")
+    operations += divert_grub()
+    operations.append(chroot.RunCommand(["update-grub"]))
+    operations += undivert_grub()
 
-    undivert_grub()
+    executor.run(operations)
 
 
-def install_bootloader(bootloader: str, device: str) -> None:
+def install_bootloader(executor: chroot.ChrootExecutor, bootloader: str, device: str) -> None:
     if bootloader == "grub":
-        install_grub(device)
+        install_grub(executor, device)
     else:
         raise ValueError(f"bootloader {bootloader} not supported")
 
 
-def setup_source_list(mirror: str, series: str) -> None:
-    f = open("/etc/apt/sources.list", "w")
+def setup_source_list(mirror: str, series: str) -> chroot.WriteFile:
     components = "main universe multiverse restricted"
-    f.write(f"deb {mirror} {series} {components}\n")
-    f.write(f"deb {mirror} {series}-updates {components}\n")
-    f.write(f"deb {mirror} {series}-security {components}\n")
+    sources = (
+        f"deb {mirror} {series} {components}\n"
+        f"deb {mirror} {series}-updates {components}\n"
+        f"deb {mirror} {series}-security {components}\n"
+    )
 
-    f.close()
+    return chroot.WriteFile("/etc/apt/sources.list", sources.encode())
 
 
 def mount_virtual_filesystems(mount_dir: str) -> None:
@@ -180,26 +246,64 @@ def copy_directory(src: str, dest: str) -> None:
 
 
 def copy_extra_files(mount_dir: str, files: Dict[str, str]) -> None:
-    for dest, local in files.items():
+    def copy_one(item: Tuple[str, str]) -> None:
+        dest, local = item
         print(f"COPYING {local} -> {dest}")
 
-        dest = f"{mount_dir}{dest}"
+        dest = overlay.image_entry(mount_dir, dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.islink(dest):
+            os.remove(dest)
 
-        directory = os.path.dirname(dest)
-        commands.run(["mkdir", "-p", directory])
+        overlay.copy_file(local, dest)
+        shutil.copymode(local, dest)
 
-        shutil.copy(local, dest)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(copy_one, files.items()))
+
+
+def chmod_operation(path: str, mode: str) -> chroot.Operation:
+    """
+    Numeric modes are applied directly, symbolic ones (eg. "u+x")
+    are passed to chmod.
+    """
+    try:
+        return chroot.Chmod(path, int(mode, 8))
+    except ValueError:
+        return chroot.RunCommand(["chmod", mode, path])
 
 
 def download_file(url: str, path: str) -> None:
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+    http_cache.get_cache().fetch(url, path)
+
+
+def download_file_operation(mount_dir: str, url: str, path: str) -> chroot.MoveFile:
+    """
+    Download a file on the host (through the HTTP cache) to the /tmp of the
+    image and return the operation moving it to its destination. The file is
+    moved from the chroot so that symlinks of the image can't redirect the
+    write to the host.
+    :param mount_dir: where the image is mounted, its /tmp must be the tmpfs
+                      mounted by mount_virtual_filesystems
+    :param url: the URL to download
+    :param path: the destination, inside the image
+    """
+    fd, staging_path = tempfile.mkstemp(dir=f"{mount_dir}/tmp", prefix="genesis-download")
+    os.close(fd)
+    try:
+        download_file(url, staging_path)
+    except Exception:
+        os.remove(staging_path)
+        raise
+
+    return chroot.MoveFile(f"/tmp/{os.path.basename(staging_path)}", path)
 
 
 def convert_binary_image(disk_image: str, binary_format: str, out_path: str) -> None:
+    if binary_format in compress.COMPRESSED_FORMATS:
+        compress.compress_image(disk_image, binary_format, out_path)
+        return
+
     commands.run(
         [
             "qemu-img",
@@ -257,10 +361,64 @@ class UEFIDisk:
         return f"/dev/{self.loop_device}p{self.esp_partition_number}"
 
 
+def finalize_disk(mount_dir: str) -> bool:
+    """
+    Drop the dead data left in the image (deleted package caches, temporary
+    files...) so it does not end up in the converted or compressed images.
+    This must run while the image is attached.
+    :return: True if the free space of the ESP was zero-filled, the zeros must
+             then be turned into holes once the image is detached (see dig_esp_holes)
+    """
+    if not disk_utils.discard_free_blocks(mount_dir):
+        print(f"WARN: could not discard the free blocks of {mount_dir}, they are not reclaimed")
+
+    esp_dir = f"{mount_dir}/boot/efi"
+    if disk_utils.discard_free_blocks(esp_dir):
+        return False
+
+    # older kernels can't discard on vfat
+    disk_utils.zero_free_space(esp_dir)
+    return True
+
+
+def dig_esp_holes(disk_image: str) -> None:
+    """
+    Punch holes where the ESP of a detached image only contains zeros.
+    """
+    with image_inspect.DiskImage(disk_image) as image:
+        esp = image.find_partition(image_inspect.ESP_GUID)
+    if esp is None:
+        raise ValueError(f"no ESP in {disk_image}")
+
+    disk_utils.dig_holes(disk_image, offset=esp.offset(), length=esp.size())
+
+
 @click.group()
-def cli() -> None:
-    verify_root()
-    pass
+@click.option(
+    "--cache-dir", type=str, default=http_cache.DEFAULT_CACHE_DIR, envvar="GENESIS_CACHE_DIR"
+)
+@click.option("--cache-size", type=int, default=1024, help="maximum size of the cache (MB)")
+@click.option("--offline/--online", default=False, envvar="GENESIS_OFFLINE")
+@click.option(
+    "--telemetry",
+    "telemetry_path",
+    type=str,
+    required=False,
+    envvar="GENESIS_TELEMETRY",
+    help="JSON file where per-stage disk I/O and space usage are recorded",
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    cache_dir: str,
+    cache_size: int,
+    offline: bool,
+    telemetry_path: Optional[str],
+) -> None:
+    if ctx.invoked_subcommand not in UNPRIVILEGED_COMMANDS:
+        verify_root()
+    http_cache.configure(cache_dir, cache_size * 1024 * 1024, offline)
+    telemetry.configure(telemetry_path)
 
 
 @cli.command()
@@ -268,9 +426,36 @@ def cli() -> None:
 @click.option("--series", type=str, required=True)
 @click.option("--mirror", type=str, default="http://archive.ubuntu.com/ubuntu", required=True)
 @click.option("--hostname", type=str, default="ubuntu", required=True)
-def debootstrap(output: str, series: str, mirror: str, hostname: str):
+@click.option(
+    "--engine",
+    type=click.Choice(["debootstrap", "native"]),
+    default="debootstrap",
+    help="native downloads and unpacks the packages in parallel",
+)
+@click.option(
+    "--keyring",
+    type=str,
+    required=False,
+    help=f"keyring used to verify the archive (default: {archive.DEFAULT_KEYRING})",
+)
+@click.option(
+    "--no-check-gpg",
+    "no_check_gpg",
+    is_flag=True,
+    default=False,
+    help="don't verify the signature of the archive",
+)
+def debootstrap(
+    output: str,
+    series: str,
+    mirror: str,
+    hostname: str,
+    engine: str,
+    keyring: Optional[str],
+    no_check_gpg: bool,
+):
     os.mkdir(output)
-    run_deboostrap(series, mirror, output)
+    run_deboostrap(series, mirror, output, engine, keyring, not no_check_gpg)
 
     f = open(f"{output}/etc/hostname", "w")
     f.write(hostname)
@@ -284,17 +469,21 @@ def create_disk(rootfs_dir: str, disk_image: str, size: int):
     disk = UEFIDisk.create(size)
     mount_dir = tempfile.mkdtemp(prefix="genesis-build")
     mount_partition(disk.rootfs_map_device(), mount_dir)
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    copy_directory(rootfs_dir, mount_dir)
-    os.mkdir(f"{mount_dir}/boot/efi")
+    with telemetry.stage("create-disk:copy-rootfs"):
+        copy_directory(rootfs_dir, mount_dir)
+        os.mkdir(f"{mount_dir}/boot/efi")
 
-    os.chroot(mount_dir)
-
-    add_fstab_entry("LABEL=rootfs\t/\text4\tdefaults\t0\t1")
-    add_fstab_entry("LABEL=UEFI\t/boot/efi\tvfat\tumask=0077\t0\t1")
-
-    exit_chroot()
+    with chroot.ChrootExecutor(mount_dir) as executor:
+        executor.run(
+            [
+                add_fstab_entry("LABEL=rootfs\t/\text4\tdefaults\t0\t1"),
+                add_fstab_entry("LABEL=UEFI\t/boot/efi\tvfat\tumask=0077\t0\t1"),
+            ]
+        )
 
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
@@ -314,17 +503,16 @@ def update_system(disk_image: str, mirror: str, series: str, extra_package: List
     mount_partition(disk.rootfs_map_device(), mount_dir)
     mount_partition(disk.esp_map_device(), f"{mount_dir}/boot/efi")
     mount_virtual_filesystems(mount_dir)
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    os.chroot(mount_dir)
-
-    os.environ["DEBIAN_FRONTEND"] = "noninteractive"
-
-    setup_source_list(mirror, series)
-    do_system_update()
+    with chroot.ChrootExecutor(mount_dir) as executor:
+        with telemetry.stage("update-system:upgrade"):
+            executor.run([setup_source_list(mirror, series)] + do_system_update())
 
-    install_extra_packages(list(extra_package))
+        with telemetry.stage("update-system:extra-packages"):
+            install_extra_packages(executor, list(extra_package))
 
-    exit_chroot()
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
@@ -335,7 +523,16 @@ def update_system(disk_image: str, mirror: str, series: str, extra_package: List
 @click.option("--file", multiple=True)
 @click.option("--owner", type=str, required=False)
 @click.option("--mod", type=str, required=False)
-def copy_files(disk_image: str, file: List[str], owner: str, mod: str):
+@click.option("--overlay", "overlays", multiple=True, help="directory or tarball[:destination]")
+@click.option("--manifest", type=str, required=False, help="YAML file with owners and modes")
+def copy_files(
+    disk_image: str,
+    file: List[str],
+    owner: str,
+    mod: str,
+    overlays: List[str],
+    manifest: Optional[str],
+):
     files = file
     disk = UEFIDisk.from_disk_image(disk_image)
 
@@ -349,18 +546,29 @@ def copy_files(disk_image: str, file: List[str], owner: str, mod: str):
         src, dst = f.split(":")
         file_map[dst] = src
 
-    copy_extra_files(mount_dir, file_map)
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    os.chroot(mount_dir)
+    for o in overlays:
+        with telemetry.stage(f"copy-files:overlay:{o}"):
+            overlay.apply_overlay(mount_dir, o)
 
+    with telemetry.stage("copy-files:files"):
+        copy_extra_files(mount_dir, file_map)
+
+    if manifest is not None:
+        overlay.apply_manifest(mount_dir, overlay.load_manifest(manifest))
+
+    operations: List[chroot.Operation] = list()
     for dest in file_map:
         if owner is not None:
-            shutil.chown(dest, owner, owner)
+            operations.append(chroot.Chown(dest, owner, owner))
         if mod is not None:
-            commands.run(["chmod", mod, dest])
+            operations.append(chmod_operation(dest, mod))
 
-    exit_chroot()
+    with chroot.ChrootExecutor(mount_dir) as executor:
+        executor.run(operations)
 
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
@@ -377,13 +585,16 @@ def download_files(disk_image: str, files: List[str]):
     mount_partition(disk.esp_map_device(), f"{mount_dir}/boot/efi")
     mount_virtual_filesystems(mount_dir)
 
-    os.chroot(mount_dir)
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    for file_url in files:
-        path, url = file_url.split(":")
-        download_file(url, path)
+    # download from the host so the HTTP cache can be used
+    with chroot.ChrootExecutor(mount_dir) as executor:
+        for file_url in files:
+            path, url = file_url.split(":", 1)
+            with telemetry.stage(f"download-files:{url}"):
+                executor.run([download_file_operation(mount_dir, url, path)])
 
-    exit_chroot()
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
@@ -400,19 +611,22 @@ def install_grub_command(disk_image: str, rootfs_label: str):
     mount_partition(disk.esp_map_device(), f"{mount_dir}/boot/efi")
     mount_virtual_filesystems(mount_dir)
 
-    grub_conf_url = "https://gist.githubusercontent.com/gjolly/14ed79fa5323a1d7a7f653f8dda60921/raw/8df1830c1ce6aa80b23515d9420c9afdc987ee1d/extra-grub-config.cfg"  # noqa
-
-    grub_config_dir = f"{mount_dir}/etc/default/grub.d"
-    if not os.path.exists(grub_config_dir):
-        os.mkdir(grub_config_dir)
-
-    download_file(grub_conf_url, f"{mount_dir}/etc/default/grub.d/extra-grub-config.cfg")
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    os.chroot(mount_dir)
+    grub_conf_url = "https://gist.githubusercontent.com/gjolly/14ed79fa5323a1d7a7f653f8dda60921/raw/8df1830c1ce6aa80b23515d9420c9afdc987ee1d/extra-grub-config.cfg"  # noqa
 
-    install_bootloader("grub", f"/dev/{disk.loop_device}")
+    with chroot.ChrootExecutor(mount_dir) as executor:
+        executor.run(
+            [
+                chroot.Mkdir("/etc/default/grub.d"),
+                download_file_operation(
+                    mount_dir, grub_conf_url, "/etc/default/grub.d/extra-grub-config.cfg"
+                ),
+            ]
+        )
 
-    exit_chroot()
+        with telemetry.stage("install-grub"):
+            install_bootloader(executor, "grub", f"/dev/{disk.loop_device}")
 
     commands.run(
         [
@@ -424,11 +638,106 @@ def install_grub_command(disk_image: str, rootfs_label: str):
         ]
     )
 
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
 
 
+@cli.command()
+@click.option("--disk-image", type=str, default="disk.img", required=True)
+def finalize(disk_image: str):
+    """
+    Discard and zero the unused blocks of the image before converting it.
+    """
+    disk = UEFIDisk.from_disk_image(disk_image)
+
+    mount_dir = tempfile.mkdtemp(prefix="genesis-build")
+    mount_partition(disk.rootfs_map_device(), mount_dir)
+    mount_partition(disk.esp_map_device(), f"{mount_dir}/boot/efi")
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
+
+    before = disk_utils.allocated_size(disk.path)
+    with telemetry.stage("finalize"):
+        esp_zeroed = finalize_disk(mount_dir)
+
+    telemetry.detach()
+    umount_all(mount_dir)
+    teardown_loop_device(disk.loop_device)
+    os.rmdir(mount_dir)
+
+    # nothing writes to the image anymore, its zeros can be turned into holes
+    if esp_zeroed:
+        dig_esp_holes(disk.path)
+
+    reclaimed = before - disk_utils.allocated_size(disk.path)
+    print(f"RECLAIMED {reclaimed // (1024 * 1024)} MB in {disk.path}")
+
+
+@cli.command("preflight")
+@click.option("--config", "config_path", type=str, required=False, help="image configuration")
+@click.option("--mirror", type=str, default=config.DEFAULT_MIRROR)
+@click.option("--series", type=str, required=False)
+@click.option("--package", multiple=True)
+@click.option("--size", type=int, required=False, help="size of the image (GB)")
+def preflight_command(
+    config_path: Optional[str],
+    mirror: str,
+    series: Optional[str],
+    package: List[str],
+    size: Optional[int],
+):
+    """
+    Resolve the packages of an image before building it.
+    """
+    packages = list(package)
+    if config_path is not None:
+        image_config = config.Config(config_path)
+        mirror = image_config.system_mirror
+        series = image_config.series
+        packages = image_config.extra_packages + [image_config.kernel_package] + packages
+        size = image_config.image_size
+
+    if series is None:
+        raise click.UsageError("--series or --config is required")
+
+    report = preflight.check(mirror, series, packages, size)
+    print(report.summary())
+
+    errors = report.errors()
+    for error in errors:
+        print(f"ERROR: {error}", file=sys.stderr)
+    if errors:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option("--disk-image", type=str, default="disk.img", required=True)
+@click.option("--format", "binary_format", type=str, default="qcow2", required=True)
+@click.option("--output", type=str, required=True)
+def convert_image(disk_image: str, binary_format: str, output: str):
+    convert_binary_image(disk_image, binary_format, output)
+
+
+@cli.command()
+@click.option("--disk-image", "disk_images", type=str, multiple=True, required=True)
+@click.option("--cat", multiple=True, help="print a file of the image")
+@click.option("--ls", multiple=True, help="list a directory of the image")
+@click.option("--kernel/--no-kernel", default=False, help="print the installed kernels")
+def inspect(disk_images: List[str], cat: List[str], ls: List[str], kernel: bool):
+    """
+    Read files from images without mounting them (no root privileges needed).
+    Several images are inspected in parallel.
+    """
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(image_inspect.inspect_image, image, list(cat), list(ls), kernel)
+            for image in disk_images
+        ]
+        for future in futures:
+            print(future.result())
+
+
 @cli.command()
 @click.option("--disk-image", type=str, default="disk.img")
 @click.option("--package", multiple=True)
@@ -440,12 +749,12 @@ def install_packages(disk_image: str, package: List[str]):
     mount_partition(disk.esp_map_device(), f"{mount_dir}/boot/efi")
     mount_virtual_filesystems(mount_dir)
 
-    os.chroot(mount_dir)
-
-    install_extra_packages(list(package))
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    exit_chroot()
+    with chroot.ChrootExecutor(mount_dir) as executor, telemetry.stage("install-packages"):
+        install_extra_packages(executor, list(package))
 
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
@@ -462,45 +771,34 @@ def create_user(disk_image: str, username: str, ssh_key: str, sudo: bool):
     mount_dir = tempfile.mkdtemp(prefix="genesis-build")
     mount_partition(disk.rootfs_map_device(), mount_dir)
 
-    os.chroot(mount_dir)
-
     user_exists: bool = False
-    with open("/etc/passwd") as passwd:
+    with open(f"{mount_dir}/etc/passwd") as passwd:
         lines = passwd.readlines()
         users = [line.split(":")[0] for line in lines]
         user_exists = username in users
 
+    operations: List[chroot.Operation] = list()
     if not user_exists:
-        commands.run(
-            [
-                "adduser",
-                "--quiet",
-                "--shell",
-                "/bin/bash",
-                "--gecos",
-                "''",
-                "--disabled-password",
-                username,
-            ]
-        )
-
+        operations.append(chroot.AddUser(username))
         # actually disable the password
-        commands.run(["passwd", "--delete", username])
+        operations.append(chroot.DeletePassword(username))
 
     if ssh_key is not None:
-        # TODO: we should use path.join here
-        home_dir = f"/home/{username}"
-        commands.run(["mkdir", "-p", f"{home_dir}/.ssh"])
+        home_dir = os.path.join("/home", username)
+        operations.append(chroot.Mkdir(os.path.join(home_dir, ".ssh")))
 
-        ssh_key_file = f"{home_dir}/.ssh/authorized_keys"
-        with open(ssh_key_file, "w") as key_file:
-            key_file.write(ssh_key)
+        ssh_key_file = os.path.join(home_dir, ".ssh", "authorized_keys")
+        operations.append(chroot.WriteFile(ssh_key_file, ssh_key.encode()))
 
     if sudo:
-        commands.run(["usermod", "-aG", "sudo", username])
+        operations.append(chroot.AddToGroup(username, "sudo"))
+
+    telemetry.attach(disk.path, disk.loop_device, mount_dir)
 
-    exit_chroot()
+    with chroot.ChrootExecutor(mount_dir) as executor, telemetry.stage("create-user"):
+        executor.run(operations)
 
+    telemetry.detach()
     umount_all(mount_dir)
     teardown_loop_device(disk.loop_device)
     os.rmdir(mount_dir)
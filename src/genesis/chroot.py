@@ -0,0 +1,246 @@
+import multiprocessing
+import os
+import shutil
+import traceback
+from multiprocessing.connection import Connection
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import genesis.commands as commands
+
+
+class WriteFile(NamedTuple):
+    path: str
+    content: bytes
+    mode: Optional[int] = None
+    append: bool = False
+
+
+class MoveFile(NamedTuple):
+    """
+    Move a file, possibly from another filesystem (the content is copied).
+    """
+
+    src: str
+    dst: str
+
+
+class Mkdir(NamedTuple):
+    path: str
+    mode: int = 0o755
+
+
+class Remove(NamedTuple):
+    path: str
+
+
+class Chown(NamedTuple):
+    path: str
+    user: str
+    group: Optional[str] = None
+
+
+class Chmod(NamedTuple):
+    path: str
+    mode: int
+
+
+class AddUser(NamedTuple):
+    username: str
+    shell: str = "/bin/bash"
+
+
+class DeletePassword(NamedTuple):
+    username: str
+
+
+class AddToGroup(NamedTuple):
+    username: str
+    group: str
+
+
+class RunCommand(NamedTuple):
+    cmd: List[str]
+    cwd: str = "/"
+    env: Dict[str, str] = dict()
+
+
+Operation = Union[
+    WriteFile,
+    MoveFile,
+    Mkdir,
+    Remove,
+    Chown,
+    Chmod,
+    AddUser,
+    DeletePassword,
+    AddToGroup,
+    RunCommand,
+]
+
+
+def edit_database(path: str, name: str, field: int, edit) -> None:
+    """
+    Edit one field of an entry in a colon separated database
+    (/etc/shadow, /etc/group, /etc/gshadow...).
+    :param path: the database file
+    :param name: the name of the entry (first field)
+    :param field: the index of the field to edit
+    :param edit: function taking the current value of the field and
+                 returning the new one
+    """
+    with open(path) as db:
+        lines = db.read().splitlines()
+
+    found = False
+    for i, line in enumerate(lines):
+        entry = line.split(":")
+        if entry[0] == name:
+            entry[field] = edit(entry[field])
+            lines[i] = ":".join(entry)
+            found = True
+
+    if not found:
+        raise ValueError(f"{name} not found in {path}")
+
+    with open(path, "w") as db:
+        db.write("\n".join(lines) + "\n")
+
+
+def add_member(members: str, username: str) -> str:
+    member_list = [m for m in members.split(",") if m != ""]
+    if username not in member_list:
+        member_list.append(username)
+
+    return ",".join(member_list)
+
+
+def apply_operation(op: Operation) -> None:
+    """
+    Apply an operation. This is called from the helper process, inside the chroot.
+    """
+    if isinstance(op, WriteFile):
+        with open(op.path, "ab" if op.append else "wb") as f:
+            f.write(op.content)
+        if op.mode is not None:
+            os.chmod(op.path, op.mode)
+    elif isinstance(op, MoveFile):
+        shutil.copyfile(op.src, op.dst)
+        os.remove(op.src)
+    elif isinstance(op, Mkdir):
+        os.makedirs(op.path, mode=op.mode, exist_ok=True)
+    elif isinstance(op, Remove):
+        os.remove(op.path)
+    elif isinstance(op, Chown):
+        shutil.chown(op.path, op.user, op.group)
+    elif isinstance(op, Chmod):
+        os.chmod(op.path, op.mode)
+    elif isinstance(op, AddUser):
+        commands.run(
+            [
+                "adduser",
+                "--quiet",
+                "--shell",
+                op.shell,
+                "--gecos",
+                "''",
+                "--disabled-password",
+                op.username,
+            ]
+        )
+    elif isinstance(op, DeletePassword):
+        edit_database("/etc/shadow", op.username, 1, lambda _: "")
+    elif isinstance(op, AddToGroup):
+        edit_database("/etc/group", op.group, 3, lambda m: add_member(m, op.username))
+        if os.path.exists("/etc/gshadow"):
+            edit_database("/etc/gshadow", op.group, 3, lambda m: add_member(m, op.username))
+    elif isinstance(op, RunCommand):
+        env = dict(os.environ)
+        env.update(op.env)
+        commands.run(op.cmd, cwd=op.cwd, env=env)
+    else:
+        raise ValueError(f"unknown operation {op}")
+
+
+def serve(root: str, conn: Connection) -> None:
+    """
+    Main loop of the helper process: enter the chroot and apply the
+    batches of operations received on the pipe until None is received.
+    """
+    os.chroot(root)
+    os.chdir("/")
+
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+
+        error: Optional[str] = None
+        for op in batch:
+            try:
+                apply_operation(op)
+            except Exception:
+                error = f"{op} failed:\n{traceback.format_exc()}"
+                break
+
+        conn.send(error)
+
+    conn.close()
+
+
+class ChrootExecutor:
+    """
+    Long-lived helper process running inside a chroot. Operations are sent
+    to it in batches over a pipe so the genesis process itself never has to
+    enter the chroot.
+    """
+
+    root: str
+    process: Optional[multiprocessing.process.BaseProcess]
+    conn: Optional[Connection]
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.process = None
+        self.conn = None
+
+    def start(self) -> None:
+        # fork (rather than spawn) so that nothing needs to be installed in the
+        # chroot to run the helper
+        ctx = multiprocessing.get_context("fork")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=serve, args=(self.root, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, operations: List[Operation]) -> None:
+        """
+        Apply a batch of operations in the chroot. Operations are applied in
+        order and the batch stops at the first failure.
+        """
+        if self.conn is None:
+            raise RuntimeError("chroot executor not started")
+
+        self.conn.send(operations)
+        try:
+            error = self.conn.recv()
+        except EOFError:
+            raise RuntimeError(f"chroot helper for {self.root} exited unexpectedly")
+
+        if error is not None:
+            raise RuntimeError(error)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.send(None)
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join()
+            self.process = None
+
+    def __enter__(self) -> "ChrootExecutor":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,16 +1,16 @@
 import subprocess
 
-from typing import List
+from typing import Dict, List, Optional
 
 
-def run(cmd: List[str], cwd: str = "") -> None:
+def run(cmd: List[str], cwd: str = "", env: Optional[Dict[str, str]] = None) -> None:
     shell_form_cmd = " ".join(cmd)
     print(f">> {shell_form_cmd}")
 
     process_cwd = None
     if cwd != "":
         process_cwd = cwd
-    proc = subprocess.Popen(cmd, cwd=process_cwd, shell=False)
+    proc = subprocess.Popen(cmd, cwd=process_cwd, env=env, shell=False)
 
     proc.communicate()
 
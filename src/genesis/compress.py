@@ -0,0 +1,159 @@
+import errno
+import os
+import struct
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+COMPRESSED_FORMATS = ["zstd", "xz"]
+
+# Size of the independent frames (zstd) or blocks (xz) the image is split into.
+# Every frame can be decompressed on its own, this is what makes the output
+# seekable.
+FRAME_SIZE = 8 * 1024 * 1024
+
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def is_hole(fd: int, offset: int, length: int) -> bool:
+    """
+    Check if a range of a sparse file is entirely unallocated.
+    """
+    try:
+        data_offset = os.lseek(fd, offset, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # there is no data after offset
+            return True
+        if e.errno == errno.EINVAL:
+            # SEEK_DATA is not supported by the filesystem, read everything
+            return False
+        raise
+
+    return data_offset >= offset + length
+
+
+def iter_chunks(path: str, chunk_size: int = FRAME_SIZE) -> Iterator[Tuple[int, Optional[bytes]]]:
+    """
+    Read a (sparse) file chunk by chunk.
+    :param path: the file to read
+    :param chunk_size: the size of the chunks
+    :return: an iterator of (length, data) where data is None if the
+             chunk is a hole in the file (and was not read)
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            if is_hole(fd, offset, length):
+                yield length, None
+            else:
+                yield length, os.pread(fd, length, offset)
+            offset += length
+    finally:
+        os.close(fd)
+
+
+def compress_zstd_frame(data: bytes, level: int) -> bytes:
+    result = subprocess.run(
+        ["zstd", "-q", "-c", f"-{level}", "--no-check"],
+        input=data,
+        stdout=subprocess.PIPE,
+        check=False,
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError("zstd failed to compress frame")
+
+    return result.stdout
+
+
+def zstd_seek_table(frames: List[Tuple[int, int]]) -> bytes:
+    """
+    Build the seek table of the zstd seekable format: a skippable frame
+    listing the compressed and decompressed size of every frame.
+    :param frames: a list of (compressed size, decompressed size)
+    """
+    entries = b"".join(struct.pack("<II", c_size, d_size) for c_size, d_size in frames)
+    # no checksums in the entries, so the descriptor is 0
+    footer = struct.pack("<IBI", len(frames), 0, ZSTD_SEEKABLE_MAGIC)
+    table = entries + footer
+
+    return struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(table)) + table
+
+
+def compress_zstd(disk_image: str, out_path: str, level: int = 3, threads: int = 0) -> None:
+    """
+    Compress a raw disk image to the seekable zstd format. Frames are compressed
+    in parallel and holes in the image are never read.
+    :param threads: number of frames compressed in parallel (0 means one per CPU)
+    """
+    workers = threads or os.cpu_count() or 1
+    print(f">> zstd seekable ({workers} threads, level {level}) {disk_image} -> {out_path}")
+
+    zero_frames: Dict[int, bytes] = dict()
+    frames: List[Tuple[int, int]] = list()
+    pending: Deque[Tuple[int, Future]] = deque()
+
+    def write_frame(out, length: int, frame: bytes) -> None:
+        out.write(frame)
+        frames.append((len(frame), length))
+
+    with open(out_path, "wb") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        for length, data in iter_chunks(disk_image):
+            if data is None:
+                if length not in zero_frames:
+                    zero_frames[length] = compress_zstd_frame(bytes(length), level)
+                future: Future = Future()
+                future.set_result(zero_frames[length])
+            else:
+                future = executor.submit(compress_zstd_frame, data, level)
+
+            pending.append((length, future))
+
+            # bound the amount of data kept in memory
+            while len(pending) > 2 * workers:
+                pending_length, pending_future = pending.popleft()
+                write_frame(out, pending_length, pending_future.result())
+
+        while pending:
+            pending_length, pending_future = pending.popleft()
+            write_frame(out, pending_length, pending_future.result())
+
+        out.write(zstd_seek_table(frames))
+
+
+def compress_xz(disk_image: str, out_path: str, level: int = 6, threads: int = 0) -> None:
+    """
+    Compress a raw disk image with multithreaded xz. The output is split
+    in independent blocks so it can be decompressed in parallel.
+    Holes in the image are not read, zeros are fed to xz directly.
+    """
+    cmd = ["xz", "-c", f"-{level}", f"-T{threads}", f"--block-size={FRAME_SIZE}"]
+    print(f">> {' '.join(cmd)} < {disk_image} > {out_path}")
+
+    with open(out_path, "wb") as out:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+        assert proc.stdin is not None
+        try:
+            for length, data in iter_chunks(disk_image):
+                proc.stdin.write(data if data is not None else bytes(length))
+        finally:
+            proc.stdin.close()
+            proc.wait()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"{cmd} failed")
+
+
+def compress_image(disk_image: str, binary_format: str, out_path: str) -> None:
+    if binary_format == "zstd":
+        compress_zstd(disk_image, out_path)
+    elif binary_format == "xz":
+        compress_xz(disk_image, out_path)
+    else:
+        raise ValueError(f"compression format {binary_format} unsupported")
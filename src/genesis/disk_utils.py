@@ -1,4 +1,7 @@
+import errno
+import os
 import tempfile
+from typing import Optional
 
 import genesis.commands as commands
 
@@ -75,3 +78,63 @@ def format_partition(device: str, partition_format: str = "ext4", label: str = "
         format_vfat_partition(device, label)
     else:
         raise ValueError(f"partition type {partition_format} unsupported")
+
+
+def allocated_size(path: str) -> int:
+    """
+    Space actually used by a (sparse) file, in bytes.
+    """
+    return os.stat(path).st_blocks * 512
+
+
+def discard_free_blocks(mount_point: str) -> bool:
+    """
+    Discard the unused blocks of a filesystem. On a loop device, this punches
+    holes in the backing file.
+    :return: False if the filesystem does not support discard
+    """
+    try:
+        commands.run(["fstrim", "--verbose", mount_point])
+    except RuntimeError:
+        return False
+
+    return True
+
+
+def zero_free_space(mount_point: str) -> None:
+    """
+    Overwrite the free space of a filesystem with zeros by filling it with a
+    temporary file.
+    """
+    zero_file = os.path.join(mount_point, ".genesis-zero")
+    print(f"ZEROING free space of {mount_point}")
+
+    chunk = bytes(1024 * 1024)
+    fd = os.open(zero_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        while True:
+            try:
+                written = os.write(fd, chunk)
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.EFBIG):
+                    break
+                raise
+            if written < len(chunk):
+                # the filesystem is full, finish with smaller writes
+                chunk = chunk[:4096]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        os.remove(zero_file)
+
+
+def dig_holes(path: str, offset: int = 0, length: Optional[int] = None) -> None:
+    """
+    Turn the ranges of zeros of a file into holes.
+    :param offset: start of the range to scan, in bytes
+    :param length: length of the range to scan (up to the end of the file by default)
+    """
+    cmd = ["fallocate", "--dig-holes", "--offset", str(offset)]
+    if length is not None:
+        cmd += ["--length", str(length)]
+    commands.run(cmd + [path])
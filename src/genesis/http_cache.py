@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import requests
+
+import genesis.overlay as overlay
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "genesis", "http"
+)
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# a git commit or a sha256 in the path means the content of the URL never changes
+# eg. https://gist.githubusercontent.com/<user>/<id>/raw/<commit>/file.cfg
+PINNED_URL = re.compile(r"/([0-9a-f]{40}|[0-9a-f]{64})/")
+
+TIMEOUT = 30
+
+
+def is_pinned(url: str) -> bool:
+    return PINNED_URL.search(url) is not None
+
+
+def parse_cache_control(header: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = dict()
+    for directive in header.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name != "":
+            directives[name.lower()] = value.strip('"') if value != "" else None
+
+    return directives
+
+
+class HTTPCache:
+    """
+    Host side cache for downloaded files. Bodies are stored with their ETag and
+    Last-Modified headers and revalidated with conditional requests. Pinned or
+    immutable URLs are served without any request.
+    """
+
+    cache_dir: str
+    max_size: int
+    offline: bool
+    session: requests.Session
+
+    def __init__(
+        self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_MAX_SIZE, offline=False
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.offline = offline
+        self.session = requests.Session()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+
+    def load_metadata(self, url: str) -> Optional[Dict[str, Any]]:
+        entry = self.entry_path(url)
+        if not os.path.exists(f"{entry}.body"):
+            return None
+
+        try:
+            with open(f"{entry}.json") as metadata_file:
+                return json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+
+    def save_metadata(self, url: str, metadata: Dict[str, Any]) -> None:
+        entry = self.entry_path(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(tmp_path, f"{entry}.json")
+
+    def is_fresh(self, metadata: Dict[str, Any]) -> bool:
+        if metadata.get("immutable", False):
+            return True
+
+        expires = metadata.get("expires")
+        return expires is not None and time.time() < expires
+
+    def fetch(self, url: str, path: str) -> None:
+        """
+        Download url to path, going through the cache.
+        """
+        metadata = self.load_metadata(url)
+
+        if metadata is not None and (self.offline or self.is_fresh(metadata)):
+            print(f"CACHED {url}")
+            self.serve(url, metadata, path)
+            return
+
+        if self.offline:
+            raise RuntimeError(f"{url} is not in the cache and offline mode is enabled")
+
+        headers: Dict[str, str] = dict()
+        if metadata is not None:
+            if metadata.get("etag") is not None:
+                headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified") is not None:
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        print(f"GET {url}")
+        try:
+            r = self.session.get(url, headers=headers, stream=True, timeout=TIMEOUT)
+        except requests.RequestException as e:
+            if metadata is None:
+                raise
+            print(f"WARN: {url} could not be revalidated ({e}), using the cached copy")
+            self.serve(url, metadata, path)
+            return
+
+        with r:
+            if r.status_code == 304 and metadata is not None:
+                metadata.update(self.freshness(url, r.headers))
+                self.serve(url, metadata, path)
+                return
+
+            if r.status_code >= 500 and metadata is not None:
+                print(
+                    f"WARN: {url} could not be revalidated ({r.status_code}), "
+                    "using the cached copy"
+                )
+                self.serve(url, metadata, path)
+                return
+
+            r.raise_for_status()
+            self.store(url, r, path)
+
+    def freshness(self, url: str, headers) -> Dict[str, Any]:
+        cache_control = parse_cache_control(headers.get("Cache-Control", ""))
+
+        expires: Optional[float] = None
+        max_age = cache_control.get("max-age")
+        if max_age is not None and max_age.isdigit() and "no-cache" not in cache_control:
+            expires = time.time() + int(max_age)
+
+        return {
+            "immutable": is_pinned(url) or "immutable" in cache_control,
+            "expires": expires,
+        }
+
+    def store(self, url: str, response: requests.Response, path: str) -> None:
+        cache_control = parse_cache_control(response.headers.get("Cache-Control", ""))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as body:
+                for chunk in response.iter_content(chunk_size=65536):
+                    body.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if "no-store" in cache_control or size > self.max_size:
+            overlay.copy_file(tmp_path, path)
+            os.remove(tmp_path)
+            return
+
+        entry = self.entry_path(url)
+        os.replace(tmp_path, f"{entry}.body")
+
+        metadata = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": size,
+        }
+        metadata.update(self.freshness(url, response.headers))
+        self.serve(url, metadata, path)
+
+        self.evict()
+
+    def serve(self, url: str, metadata: Dict[str, Any], path: str) -> None:
+        metadata["last_used"] = time.time()
+        self.save_metadata(url, metadata)
+
+        overlay.copy_file(f"{self.entry_path(url)}.body", path)
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in max_size.
+        """
+        entries: List[Dict[str, Any]] = list()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, name)) as metadata_file:
+                    entries.append(json.load(metadata_file))
+            except (OSError, ValueError):
+                continue
+
+        total = sum(e.get("size", 0) for e in entries)
+        for e in sorted(entries, key=lambda e: e.get("last_used", 0)):
+            if total <= self.max_size:
+                break
+
+            entry = self.entry_path(e["url"])
+            for suffix in [".body", ".json"]:
+                if os.path.exists(f"{entry}{suffix}"):
+                    os.remove(f"{entry}{suffix}")
+            total -= e.get("size", 0)
+
+
+cache: Optional[HTTPCache] = None
+
+
+def configure(cache_dir: str = DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, offline=False):
+    global cache
+    cache = HTTPCache(cache_dir, max_size, offline)
+
+
+def get_cache() -> HTTPCache:
+    if cache is None:
+        configure()
+
+    assert cache is not None
+    return cache
@@ -0,0 +1,547 @@
+import mmap
+import os
+import posixpath
+import struct
+import uuid
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+SECTOR_SIZE = 512
+
+LINUX_FILESYSTEM_GUID = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+ESP_GUID = uuid.UUID("c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+
+# where the ESP is mounted on the images built by genesis (see create_disk)
+ESP_MOUNT_POINT = "/boot/efi"
+
+MAX_SYMLINKS = 40
+
+
+class Partition(NamedTuple):
+    number: int
+    type_guid: uuid.UUID
+    first_lba: int
+    last_lba: int
+    name: str
+
+    def offset(self) -> int:
+        return self.first_lba * SECTOR_SIZE
+
+    def size(self) -> int:
+        return (self.last_lba - self.first_lba + 1) * SECTOR_SIZE
+
+
+def parse_gpt(mm: mmap.mmap) -> List[Partition]:
+    """
+    Parse the GPT partition table (as written by partition_uefi_disk).
+    """
+    header = mm[SECTOR_SIZE : 2 * SECTOR_SIZE]
+    if header[0:8] != b"EFI PART":
+        raise ValueError("no GPT partition table found")
+
+    entries_lba, num_entries, entry_size = struct.unpack_from("<QII", header, 0x48)
+
+    partitions: List[Partition] = list()
+    for i in range(num_entries):
+        offset = entries_lba * SECTOR_SIZE + i * entry_size
+        entry = mm[offset : offset + entry_size]
+        type_guid = uuid.UUID(bytes_le=entry[0:16])
+        if type_guid.int == 0:
+            continue
+
+        first_lba, last_lba = struct.unpack_from("<QQ", entry, 32)
+        name = entry[56:128].decode("utf-16-le").rstrip("\0")
+        partitions.append(Partition(i + 1, type_guid, first_lba, last_lba, name))
+
+    return partitions
+
+
+def split_path(path: str) -> List[str]:
+    return [c for c in path.split("/") if c not in ("", ".")]
+
+
+class Ext4:
+    """
+    Read-only access to an ext4 filesystem.
+    """
+
+    EXTENTS_FL = 0x80000
+    INLINE_DATA_FL = 0x10000000
+    INCOMPAT_64BIT = 0x80
+    EXTENT_MAGIC = 0xF30A
+    ROOT_INODE = 2
+
+    S_IFMT = 0o170000
+    S_IFDIR = 0o040000
+    S_IFLNK = 0o120000
+
+    mm: mmap.mmap
+    offset: int
+    block_size: int
+    inodes_per_group: int
+    inode_size: int
+    desc_size: int
+    gdt_offset: int
+
+    def __init__(self, mm: mmap.mmap, offset: int) -> None:
+        self.mm = mm
+        self.offset = offset
+
+        sb = mm[offset + 1024 : offset + 2048]
+        (magic,) = struct.unpack_from("<H", sb, 0x38)
+        if magic != 0xEF53:
+            raise ValueError(f"no ext4 filesystem at offset {offset}")
+
+        first_data_block, log_block_size = struct.unpack_from("<II", sb, 0x14)
+        (self.inodes_per_group,) = struct.unpack_from("<I", sb, 0x28)
+        (rev_level,) = struct.unpack_from("<I", sb, 0x4C)
+        (inode_size,) = struct.unpack_from("<H", sb, 0x58)
+        (feature_incompat,) = struct.unpack_from("<I", sb, 0x60)
+        (desc_size,) = struct.unpack_from("<H", sb, 0xFE)
+
+        self.block_size = 1024 << log_block_size
+        self.inode_size = inode_size if rev_level >= 1 else 128
+        self.desc_size = desc_size if feature_incompat & self.INCOMPAT_64BIT else 32
+        self.gdt_offset = (first_data_block + 1) * self.block_size
+
+    def block(self, number: int, count: int = 1) -> bytes:
+        start = self.offset + number * self.block_size
+        return self.mm[start : start + count * self.block_size]
+
+    def inode(self, number: int) -> bytes:
+        group, index = divmod(number - 1, self.inodes_per_group)
+
+        desc_offset = self.offset + self.gdt_offset + group * self.desc_size
+        desc = self.mm[desc_offset : desc_offset + self.desc_size]
+        (table,) = struct.unpack_from("<I", desc, 0x8)
+        if self.desc_size >= 64:
+            (table_hi,) = struct.unpack_from("<I", desc, 0x28)
+            table |= table_hi << 32
+
+        start = self.offset + table * self.block_size + index * self.inode_size
+        return self.mm[start : start + self.inode_size]
+
+    @staticmethod
+    def mode(inode: bytes) -> int:
+        return struct.unpack_from("<H", inode, 0)[0]
+
+    @staticmethod
+    def size(inode: bytes) -> int:
+        (size_lo,) = struct.unpack_from("<I", inode, 0x4)
+        (size_hi,) = struct.unpack_from("<I", inode, 0x6C)
+        return size_lo | size_hi << 32
+
+    def extents(self, node: bytes) -> List[Tuple[int, int, int]]:
+        """
+        Walk an extent tree.
+        :return: a list of (logical block, number of blocks, physical block)
+        """
+        magic, entries, _, depth = struct.unpack_from("<HHHH", node, 0)
+        if magic != self.EXTENT_MAGIC:
+            raise ValueError("corrupted extent tree")
+
+        extents: List[Tuple[int, int, int]] = list()
+        for i in range(entries):
+            entry_offset = 12 + i * 12
+            if depth == 0:
+                logical, length, start_hi, start_lo = struct.unpack_from(
+                    "<IHHI", node, entry_offset
+                )
+                # uninitialized extents read as zeros
+                if length <= 32768:
+                    extents.append((logical, length, start_hi << 32 | start_lo))
+            else:
+                _, leaf_lo, leaf_hi = struct.unpack_from("<IIH", node, entry_offset)
+                extents.extend(self.extents(self.block(leaf_hi << 32 | leaf_lo)))
+
+        return extents
+
+    def mapped_blocks(self, inode: bytes) -> List[Tuple[int, int, int]]:
+        """
+        Blocks of a file using the ext2/ext3 block map.
+        """
+        per_block = self.block_size // 4
+        nblocks = (self.size(inode) + self.block_size - 1) // self.block_size
+        pointers = list(struct.unpack_from("<15I", inode, 0x28))
+
+        def indirect(block: int, level: int, limit: int) -> List[int]:
+            """
+            Resolve at most limit blocks from an indirect block.
+            """
+            if block == 0:
+                return [0] * min(limit, per_block**level)
+            children = struct.unpack(f"<{per_block}I", self.block(block))
+            if level == 1:
+                return list(children[:limit])
+
+            blocks: List[int] = list()
+            for child in children:
+                if len(blocks) >= limit:
+                    break
+                blocks.extend(indirect(child, level - 1, limit - len(blocks)))
+            return blocks
+
+        blocks = pointers[:12]
+        for level, pointer in enumerate(pointers[12:], start=1):
+            if len(blocks) >= nblocks:
+                break
+            blocks.extend(indirect(pointer, level, nblocks - len(blocks)))
+
+        return [(i, 1, b) for i, b in enumerate(blocks[:nblocks]) if b != 0]
+
+    def read_inode(self, inode: bytes) -> bytes:
+        size = self.size(inode)
+        (flags,) = struct.unpack_from("<I", inode, 0x20)
+
+        if flags & self.INLINE_DATA_FL:
+            raise ValueError("inline data is not supported")
+
+        if flags & self.EXTENTS_FL:
+            extents = self.extents(inode[0x28 : 0x28 + 60])
+        else:
+            extents = self.mapped_blocks(inode)
+
+        data = bytearray(size)
+        for logical, length, physical in extents:
+            start = logical * self.block_size
+            if start >= size:
+                continue
+            chunk = self.block(physical, length)[: size - start]
+            data[start : start + len(chunk)] = chunk
+
+        return bytes(data)
+
+    def entries(self, inode: bytes) -> Dict[str, int]:
+        """
+        Read a directory (linear and hashed directories are both readable
+        linearly, hash tree nodes look like empty entries).
+        """
+        data = self.read_inode(inode)
+        entries: Dict[str, int] = dict()
+
+        offset = 0
+        while offset + 8 <= len(data):
+            number, rec_len, name_len = struct.unpack_from("<IHB", data, offset)
+            if rec_len < 8:
+                break
+            if number != 0:
+                name = data[offset + 8 : offset + 8 + name_len]
+                entries[name.decode(errors="surrogateescape")] = number
+            offset += rec_len
+
+        return entries
+
+    def readlink(self, inode: bytes) -> str:
+        size = self.size(inode)
+        (flags,) = struct.unpack_from("<I", inode, 0x20)
+        if size < 60 and not flags & self.EXTENTS_FL:
+            # fast symlink, the target is stored in the inode
+            target = inode[0x28 : 0x28 + size]
+        else:
+            target = self.read_inode(inode)
+
+        return target.decode(errors="surrogateescape")
+
+    def lookup(self, path: str, follow: bool = True) -> bytes:
+        """
+        Find the inode of a path, following symlinks (absolute symlinks are
+        relative to the root of this filesystem).
+        """
+        remaining = split_path(path)
+        stack = [self.inode(self.ROOT_INODE)]
+        symlinks = 0
+
+        while remaining:
+            name = remaining.pop(0)
+            current = stack[-1]
+            if self.mode(current) & self.S_IFMT != self.S_IFDIR:
+                raise NotADirectoryError(path)
+
+            if name == "..":
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+
+            number = self.entries(current).get(name)
+            if number is None:
+                raise FileNotFoundError(path)
+
+            inode = self.inode(number)
+            is_last = len(remaining) == 0
+            if self.mode(inode) & self.S_IFMT == self.S_IFLNK and (follow or not is_last):
+                symlinks += 1
+                if symlinks > MAX_SYMLINKS:
+                    raise OSError(f"too many levels of symbolic links: {path}")
+                target = self.readlink(inode)
+                if target.startswith("/"):
+                    stack = stack[:1]
+                remaining = split_path(target) + remaining
+                continue
+
+            stack.append(inode)
+
+        return stack[-1]
+
+    def read_file(self, path: str) -> bytes:
+        inode = self.lookup(path)
+        if self.mode(inode) & self.S_IFMT == self.S_IFDIR:
+            raise IsADirectoryError(path)
+
+        return self.read_inode(inode)
+
+    def list_dir(self, path: str) -> List[str]:
+        inode = self.lookup(path)
+        if self.mode(inode) & self.S_IFMT != self.S_IFDIR:
+            raise NotADirectoryError(path)
+
+        return sorted(name for name in self.entries(inode) if name not in (".", ".."))
+
+
+class Vfat:
+    """
+    Read-only access to a FAT16/FAT32 filesystem (like the ESP).
+    """
+
+    ATTR_LFN = 0x0F
+    ATTR_DIRECTORY = 0x10
+    ATTR_VOLUME_ID = 0x08
+
+    mm: mmap.mmap
+    offset: int
+    cluster_size: int
+    fat_offset: int
+    data_offset: int
+    fat32: bool
+    root_cluster: int
+    root_dir_offset: int
+    root_dir_size: int
+
+    def __init__(self, mm: mmap.mmap, offset: int) -> None:
+        self.mm = mm
+        self.offset = offset
+
+        bpb = mm[offset : offset + 512]
+        if bpb[510:512] != b"\x55\xaa":
+            raise ValueError(f"no FAT filesystem at offset {offset}")
+
+        bytes_per_sector, sectors_per_cluster, reserved, num_fats, root_entries = (
+            struct.unpack_from("<HBHBH", bpb, 11)
+        )
+        total_sectors, fat_size = struct.unpack_from("<HxH", bpb, 19)
+        if total_sectors == 0:
+            (total_sectors,) = struct.unpack_from("<I", bpb, 32)
+        if fat_size == 0:
+            (fat_size,) = struct.unpack_from("<I", bpb, 36)
+
+        root_dir_sectors = (root_entries * 32 + bytes_per_sector - 1) // bytes_per_sector
+        first_data_sector = reserved + num_fats * fat_size + root_dir_sectors
+        clusters = (total_sectors - first_data_sector) // sectors_per_cluster
+        if clusters < 4085:
+            raise ValueError("FAT12 is not supported")
+
+        self.fat32 = clusters >= 65525
+        self.cluster_size = bytes_per_sector * sectors_per_cluster
+        self.fat_offset = offset + reserved * bytes_per_sector
+        self.data_offset = offset + first_data_sector * bytes_per_sector
+        self.root_dir_offset = self.data_offset - root_dir_sectors * bytes_per_sector
+        self.root_dir_size = root_dir_sectors * bytes_per_sector
+        self.root_cluster = struct.unpack_from("<I", bpb, 44)[0] if self.fat32 else 0
+
+    def chain(self, cluster: int) -> List[int]:
+        clusters: List[int] = list()
+        while 2 <= cluster and len(clusters) < 1 << 28:
+            clusters.append(cluster)
+            if self.fat32:
+                (cluster,) = struct.unpack_from("<I", self.mm, self.fat_offset + cluster * 4)
+                cluster &= 0x0FFFFFFF
+                if cluster >= 0x0FFFFFF8:
+                    break
+            else:
+                (cluster,) = struct.unpack_from("<H", self.mm, self.fat_offset + cluster * 2)
+                if cluster >= 0xFFF8:
+                    break
+
+        return clusters
+
+    def read_clusters(self, cluster: int) -> bytes:
+        chunks = list()
+        for c in self.chain(cluster):
+            start = self.data_offset + (c - 2) * self.cluster_size
+            chunks.append(self.mm[start : start + self.cluster_size])
+
+        return b"".join(chunks)
+
+    def entries(self, cluster: int) -> Dict[str, Tuple[int, int, bool]]:
+        """
+        Read a directory.
+        :return: lowercased name -> (first cluster, size, is a directory)
+        """
+        if cluster == 0:
+            start = self.root_dir_offset
+            data = self.mm[start : start + self.root_dir_size]
+        else:
+            data = self.read_clusters(cluster)
+
+        entries: Dict[str, Tuple[int, int, bool]] = dict()
+        long_name: List[str] = list()
+        for offset in range(0, len(data), 32):
+            entry = data[offset : offset + 32]
+            if entry[0] == 0x00:
+                break
+            if entry[0] == 0xE5:
+                long_name = list()
+                continue
+
+            attr = entry[11]
+            if attr == self.ATTR_LFN:
+                part = entry[1:11] + entry[14:26] + entry[28:32]
+                chars = part.decode("utf-16-le").split("\0")[0].rstrip("￿")
+                long_name.insert(0, chars)
+                continue
+
+            if attr & self.ATTR_VOLUME_ID:
+                long_name = list()
+                continue
+
+            if long_name:
+                name = "".join(long_name)
+            else:
+                base = entry[0:8].decode("ascii", errors="replace").rstrip()
+                ext = entry[8:11].decode("ascii", errors="replace").rstrip()
+                if entry[0] == 0x05:
+                    base = "\xe5" + base[1:]
+                if entry[12] & 0x08:
+                    base = base.lower()
+                if entry[12] & 0x10:
+                    ext = ext.lower()
+                name = f"{base}.{ext}" if ext else base
+            long_name = list()
+
+            cluster_hi, cluster_lo, size = struct.unpack_from("<HxxxxHI", entry, 20)
+            first_cluster = cluster_hi << 16 | cluster_lo if self.fat32 else cluster_lo
+            entries[name] = (first_cluster, size, bool(attr & self.ATTR_DIRECTORY))
+
+        return entries
+
+    def lookup(self, path: str) -> Tuple[int, int, bool]:
+        cluster, size, is_dir = self.root_cluster, 0, True
+        for name in split_path(path):
+            if not is_dir:
+                raise NotADirectoryError(path)
+
+            # FAT is case insensitive
+            entries = {n.lower(): e for n, e in self.entries(cluster).items()}
+            if name.lower() not in entries:
+                raise FileNotFoundError(path)
+            cluster, size, is_dir = entries[name.lower()]
+            if is_dir and cluster == 0:
+                # ".." pointing to the root directory
+                cluster = self.root_cluster
+
+        return cluster, size, is_dir
+
+    def read_file(self, path: str) -> bytes:
+        cluster, size, is_dir = self.lookup(path)
+        if is_dir:
+            raise IsADirectoryError(path)
+
+        return self.read_clusters(cluster)[:size] if size > 0 else b""
+
+    def list_dir(self, path: str) -> List[str]:
+        cluster, _, is_dir = self.lookup(path)
+        if not is_dir:
+            raise NotADirectoryError(path)
+
+        return sorted(name for name in self.entries(cluster) if name not in (".", ".."))
+
+
+class DiskImage:
+    """
+    Read-only access to the files of an image built by genesis, directly from
+    the image file: no loop device, no mount and no root privileges needed.
+    """
+
+    path: str
+    mm: mmap.mmap
+    partitions: List[Partition]
+    rootfs: Ext4
+    esp: Optional[Vfat]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as image_file:
+            self.mm = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.partitions = parse_gpt(self.mm)
+
+        rootfs = self.find_partition(LINUX_FILESYSTEM_GUID)
+        if rootfs is None:
+            raise ValueError(f"no root filesystem partition in {path}")
+        self.rootfs = Ext4(self.mm, rootfs.offset())
+
+        esp = self.find_partition(ESP_GUID)
+        self.esp = Vfat(self.mm, esp.offset()) if esp is not None else None
+
+    def find_partition(self, type_guid: uuid.UUID) -> Optional[Partition]:
+        return next((p for p in self.partitions if p.type_guid == type_guid), None)
+
+    def filesystem(self, path: str):
+        """
+        Find the filesystem holding path, the ESP is mounted on /boot/efi.
+        :return: the filesystem and the path relative to it
+        """
+        path = posixpath.normpath(posixpath.join("/", path))
+        if self.esp is not None and (
+            path == ESP_MOUNT_POINT or path.startswith(ESP_MOUNT_POINT + "/")
+        ):
+            return self.esp, path[len(ESP_MOUNT_POINT) :] or "/"
+
+        return self.rootfs, path
+
+    def read_file(self, path: str) -> bytes:
+        fs, fs_path = self.filesystem(path)
+        return fs.read_file(fs_path)
+
+    def list_dir(self, path: str) -> List[str]:
+        fs, fs_path = self.filesystem(path)
+        return fs.list_dir(fs_path)
+
+    def kernel_versions(self) -> List[str]:
+        return [
+            name.removeprefix("vmlinuz-")
+            for name in self.list_dir("/boot")
+            if name.startswith("vmlinuz-")
+        ]
+
+    def close(self) -> None:
+        self.mm.close()
+
+    def __enter__(self) -> "DiskImage":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def inspect_image(path: str, cat: List[str], ls: List[str], kernel: bool) -> str:
+    """
+    Collect the requested information about an image (run in a worker process
+    when inspecting several images).
+    """
+    out: List[str] = [f"==> {path} <=="]
+    try:
+        with DiskImage(path) as image:
+            for p in image.partitions:
+                size = p.size() // (1024 * 1024)
+                out.append(f"partition {p.number}: {p.type_guid} {size}MB {p.name}")
+            if kernel:
+                out.append(f"kernel: {' '.join(image.kernel_versions())}")
+            for directory in ls:
+                out.append(f"--- ls {directory}")
+                out.extend(image.list_dir(directory))
+            for f in cat:
+                out.append(f"--- cat {f}")
+                out.append(image.read_file(f).decode(errors="replace").rstrip("\n"))
+    except (OSError, ValueError, struct.error) as e:
+        out.append(f"ERROR: {e}")
+
+    return os.linesep.join(out)
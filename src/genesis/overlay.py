@@ -0,0 +1,285 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+import genesis.commands as commands
+
+# ioctl number of FICLONE (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+MAX_SYMLINKS = 40
+
+
+def image_path(root: str, path: str) -> str:
+    """
+    Resolve a path of the image mounted on root the way it would be resolved
+    in a chroot: symlinks are followed relative to root and ".." never goes
+    above it, so the result is always inside root.
+    :param root: where the image is mounted
+    :param path: a path in the image, it does not have to exist
+    :return: the path on the host
+    """
+    root = os.path.abspath(root)
+    remaining = path.split("/")
+    resolved: List[str] = list()
+    symlinks = 0
+
+    while remaining:
+        name = remaining.pop(0)
+        if name in ("", "."):
+            continue
+        if name == "..":
+            if resolved:
+                resolved.pop()
+            continue
+
+        candidate = os.path.join(root, *resolved, name)
+        if os.path.islink(candidate):
+            symlinks += 1
+            if symlinks > MAX_SYMLINKS:
+                raise OSError(errno.ELOOP, f"too many levels of symbolic links: {path}")
+            target = os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = list()
+            remaining = target.split("/") + remaining
+            continue
+
+        resolved.append(name)
+
+    host_path = os.path.join(root, *resolved)
+    if os.path.commonpath([root, host_path]) != root:
+        raise RuntimeError(f"{path} resolves outside of {root}")
+
+    return host_path
+
+
+def image_entry(root: str, path: str) -> str:
+    """
+    Like image_path but the last component of path is not followed, for
+    paths that are going to be replaced.
+    """
+    parent, name = os.path.split(path.rstrip("/"))
+    if name in ("", ".", ".."):
+        return image_path(root, path)
+
+    return os.path.join(image_path(root, parent or "/"), name)
+
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+
+    return True
+
+
+def copy_file(src: str, dst: str) -> None:
+    """
+    Copy the content of a file, sharing the extents with the source if the
+    filesystem supports reflinks and letting the kernel do the copy
+    (copy_file_range) otherwise.
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if reflink(fsrc.fileno(), fdst.fileno()):
+            return
+
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            # copy_file_range is not supported across filesystems on old kernels
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def copy_xattrs(src: str, dst: str) -> None:
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        return
+
+    for name in names:
+        value = os.getxattr(src, name, follow_symlinks=False)
+        os.setxattr(dst, name, value, follow_symlinks=False)
+
+
+def apply_metadata(src: str, dst: str) -> None:
+    """
+    Give dst the owner, mode and extended attributes of src.
+    """
+    st = os.lstat(src)
+    os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    copy_xattrs(src, dst)
+
+
+def copy_tree(src_dir: str, mount_dir: str, dest: str = "/") -> None:
+    """
+    Copy a directory tree in the image, the files are copied in parallel.
+    Owners, modes and extended attributes are preserved. Directories that
+    already exist in the image are left untouched, and symlinks of the image
+    (eg. /bin -> usr/bin) are followed inside the image.
+    :param src_dir: the directory to copy
+    :param mount_dir: where the image is mounted
+    :param dest: where to copy the tree, in the image
+    """
+    directories: List[Tuple[str, str]] = list()
+    files: List[Tuple[str, str]] = list()
+
+    # first pass: create the directories and the symlinks and list the files
+    for root, dirs, names in os.walk(src_dir):
+        rel = os.path.relpath(root, src_dir)
+        dest_root = image_path(mount_dir, os.path.join(dest, rel))
+        if not os.path.lexists(dest_root):
+            os.makedirs(dest_root)
+            directories.append((root, dest_root))
+        elif not os.path.isdir(dest_root):
+            raise RuntimeError(f"cannot overwrite {dest_root} with a directory")
+
+        for name in dirs + names:
+            src = os.path.join(root, name)
+            dst = os.path.join(dest_root, name)
+            st = os.lstat(src)
+
+            if stat.S_ISLNK(st.st_mode):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src), dst)
+                apply_metadata(src, dst)
+            elif stat.S_ISREG(st.st_mode):
+                files.append((src, dst))
+            elif not stat.S_ISDIR(st.st_mode):
+                print(f"WARN: skipping special file {src}")
+
+    def copy_one(paths: Tuple[str, str]) -> None:
+        src, dst = paths
+        if os.path.islink(dst):
+            os.remove(dst)
+        elif os.path.lexists(dst) and not os.path.isfile(dst):
+            raise RuntimeError(f"cannot overwrite {dst} with a file")
+        copy_file(src, dst)
+        apply_metadata(src, dst)
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(copy_one, files))
+
+    # directories last and deepest first, so restrictive modes don't
+    # prevent populating them
+    for src, dst in reversed(directories):
+        apply_metadata(src, dst)
+
+
+def extract_tarball(tarball: str, dest_dir: str) -> None:
+    commands.run(
+        [
+            "tar",
+            "--extract",
+            "--file",
+            tarball,
+            "--directory",
+            dest_dir,
+            "--same-permissions",
+            "--same-owner",
+            "--numeric-owner",
+            "--xattrs",
+            "--xattrs-include=*",
+        ]
+    )
+
+
+def read_ids(database: str) -> Dict[str, int]:
+    """
+    Read a passwd or group file and map names to ids.
+    """
+    ids: Dict[str, int] = dict()
+    with open(database) as db:
+        for line in db:
+            entry = line.split(":")
+            if len(entry) > 2:
+                ids[entry[0]] = int(entry[2])
+
+    return ids
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Load a manifest file describing the metadata of files of the image.
+    eg.
+    /etc/ssh/sshd_config.d/50-image.conf:
+      owner: root
+      group: root
+      mode: "0600"
+    """
+    with open(manifest_path) as manifest_file:
+        manifest = yaml.safe_load(manifest_file)
+
+    return manifest or dict()
+
+
+def apply_manifest(mount_dir: str, manifest: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Apply owners and modes from a manifest. Names are resolved with the
+    passwd and group databases of the image, not the ones of the host.
+    """
+    users = read_ids(image_path(mount_dir, "/etc/passwd"))
+    groups = read_ids(image_path(mount_dir, "/etc/group"))
+
+    for path, spec in manifest.items():
+        dest = image_path(mount_dir, path)
+
+        owner: Optional[str] = spec.get("owner")
+        group: Optional[str] = spec.get("group", owner)
+        if owner is not None and owner not in users:
+            raise ValueError(f"{path}: user {owner} does not exist in the image")
+        if group is not None and group not in groups:
+            raise ValueError(f"{path}: group {group} does not exist in the image")
+
+        uid = users[owner] if owner is not None else -1
+        gid = groups[group] if group is not None else -1
+        if uid != -1 or gid != -1:
+            os.chown(dest, uid, gid)
+
+        mode = spec.get("mode")
+        if mode is not None:
+            os.chmod(dest, mode if isinstance(mode, int) else int(mode, 8))
+
+
+def apply_overlay(mount_dir: str, overlay: str) -> None:
+    """
+    Apply an overlay to the image.
+    :param overlay: a directory or a tarball, optionally followed by
+                    ":<destination>" (defaults to the root of the image)
+    """
+    src, _, dest = overlay.partition(":")
+    dest = dest or "/"
+    print(f"OVERLAY {src} -> {dest}")
+
+    if os.path.isdir(src):
+        copy_tree(src, mount_dir, dest)
+    elif os.path.isfile(src):
+        # extract on the host first, tar would follow the symlinks of the image
+        staging_dir = tempfile.mkdtemp(prefix="genesis-overlay")
+        try:
+            extract_tarball(src, staging_dir)
+            copy_tree(staging_dir, mount_dir, dest)
+        finally:
+            shutil.rmtree(staging_dir)
+    else:
+        raise ValueError(f"overlay {src} is neither a directory nor a tarball")
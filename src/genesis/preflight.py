@@ -0,0 +1,204 @@
+import contextlib
+import gzip
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+import genesis.archive as archive
+import genesis.bootstrap as bootstrap
+
+INDEX_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "genesis", "index"
+)
+
+# what setup_source_list configures on the image
+COMPONENTS = ["main", "universe", "multiverse", "restricted"]
+POCKETS = ["", "-updates", "-security"]
+
+# only the fields needed to resolve packages are kept in the cached indices
+FIELDS = [
+    "Package",
+    "Version",
+    "Priority",
+    "Essential",
+    "Pre-Depends",
+    "Depends",
+    "Recommends",
+    "Provides",
+    "Size",
+    "Installed-Size",
+]
+
+# size of the BIOS boot partition and the ESP (see partition_uefi_disk)
+BOOT_PARTITIONS_SIZE = 110 * 1024 * 1024
+# mkfs.ext4 -i 8192 with 256 bytes inodes
+EXT4_INODE_OVERHEAD = 256 / 8192
+
+GIB = 1024 * 1024 * 1024
+MIB = 1024 * 1024
+
+
+def load_suite(
+    mirror: str,
+    suite: str,
+    arch: str,
+    components: List[str],
+    session: requests.Session,
+    cache_dir: str = INDEX_CACHE_DIR,
+) -> List[Dict[str, str]]:
+    """
+    Get the packages of a suite. Packages indices are only downloaded and parsed
+    when the Release file changed, a compact version is cached otherwise.
+    """
+    # nothing is installed from the indices, only their sizes are used
+    release = archive.fetch_release(mirror, suite, session, keyring=None)
+
+    # suite names contain dashes, not underscores
+    cache_prefix = f"{suite}_{arch}_{'+'.join(components)}_"
+    cache_path = os.path.join(cache_dir, f"{cache_prefix}{release.hash}.json.gz")
+    if os.path.exists(cache_path):
+        with gzip.open(cache_path, "rt") as cache_file:
+            return json.load(cache_file)
+
+    stanzas: List[Dict[str, str]] = list()
+    for component in components:
+        prefix = f"{component}/binary-{arch}/"
+        if not any(path.startswith(prefix) for path in release.sha256):
+            continue
+
+        content = archive.fetch_packages(mirror, suite, component, arch, release, session)
+        for stanza in archive.parse_control(content):
+            stanzas.append({k: v for k, v in stanza.items() if k in FIELDS})
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    with gzip.open(tmp_path, "wt") as cache_file:
+        json.dump(stanzas, cache_file, separators=(",", ":"))
+    os.replace(tmp_path, cache_path)
+
+    # the indices of the previous Release files of the suite are never used again
+    for name in os.listdir(cache_dir):
+        if name.startswith(cache_prefix) and name != os.path.basename(cache_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(cache_dir, name))
+
+    return stanzas
+
+
+def load_index(
+    mirror: str, series: str, arch: str, components: List[str] = COMPONENTS
+) -> archive.PackageIndex:
+    """
+    Load the packages available on the image once its sources.list is set up.
+    """
+    session = bootstrap.create_session(len(POCKETS))
+    suites = [f"{series}{pocket}" for pocket in POCKETS]
+
+    def load(suite: str) -> Optional[List[Dict[str, str]]]:
+        try:
+            return load_suite(mirror, suite, arch, components, session)
+        except (requests.HTTPError, FileNotFoundError):
+            # some mirrors (and test fixtures) don't carry all the pockets
+            if suite == series:
+                raise
+            print(f"WARN: {suite} not found on {mirror}, ignoring")
+            return None
+
+    index = archive.PackageIndex()
+    with ThreadPoolExecutor(max_workers=len(suites)) as executor:
+        for stanzas in executor.map(load, suites):
+            for stanza in stanzas or list():
+                index.add(stanza)
+
+    return index
+
+
+class Report:
+    """
+    Result of the pre-flight resolution of the packages of an image.
+    """
+
+    requested: List[str]
+    packages: List[str]
+    missing: Dict[str, str]
+    download_size: int
+    installed_size: int
+    image_size: Optional[int]
+
+    def available_size(self) -> Optional[int]:
+        """
+        Space usable on the root filesystem, in bytes.
+        """
+        if self.image_size is None:
+            return None
+
+        rootfs_size = self.image_size * GIB - BOOT_PARTITIONS_SIZE
+        return int(rootfs_size * (1 - EXT4_INODE_OVERHEAD))
+
+    def errors(self) -> List[str]:
+        errors: List[str] = list()
+        for dependency, required_by in self.missing.items():
+            if required_by == "":
+                errors.append(f"package {dependency} not found")
+            else:
+                errors.append(f"package {dependency} (needed by {required_by}) not found")
+
+        available = self.available_size()
+        if available is not None and self.installed_size > available:
+            errors.append(
+                f"installed size ({self.installed_size // MIB} MB) does not fit in "
+                f"a {self.image_size} GB image ({available // MIB} MB usable)"
+            )
+
+        return errors
+
+    def summary(self) -> str:
+        lines = [
+            f"{len(self.packages)} packages to install",
+            f"download size: {self.download_size // MIB} MB",
+            f"installed size: {self.installed_size // MIB} MB",
+        ]
+        available = self.available_size()
+        if available is not None:
+            lines.append(f"usable space on the rootfs: {available // MIB} MB")
+
+        return "\n".join(lines)
+
+
+def check(
+    mirror: str,
+    series: str,
+    packages: List[str],
+    image_size: Optional[int] = None,
+    arch: Optional[str] = None,
+) -> Report:
+    """
+    Resolve the packages of an image before building it.
+    :param mirror: the mirror configured on the image
+    :param series: the series of the image
+    :param packages: the packages installed on top of the base system
+    :param image_size: size of the image in GB, if None the size is not checked
+    :return: a report, see Report.errors()
+    """
+    index = load_index(mirror, series, arch or bootstrap.host_architecture())
+
+    base = index.by_priority(["required", "important"])
+    # apt installs recommended packages by default
+    resolved, missing = index.resolve(base + packages, recommends=True)
+
+    report = Report()
+    report.requested = packages
+    report.packages = resolved
+    report.missing = missing
+    report.image_size = image_size
+    report.download_size = sum(int(index.packages[p].get("Size", 0)) for p in resolved)
+    report.installed_size = sum(
+        int(index.packages[p].get("Installed-Size", 0)) * 1024 for p in resolved
+    )
+
+    return report
@@ -0,0 +1,258 @@
+import contextlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+SECTOR_SIZE = 512
+
+
+class Sample(NamedTuple):
+    time: float
+    read_ios: int
+    read_bytes: int
+    write_ios: int
+    write_bytes: int
+    fs_used: int
+    image_allocated: int
+
+
+def package_changes(
+    before: Dict[str, int], after: Dict[str, int], requested: List[str]
+) -> List[Dict[str, Any]]:
+    """
+    Compare two snapshots of the dpkg database of an image.
+    :param before: installed packages and their size before the installation
+    :param after: installed packages and their size after the installation
+    :param requested: the packages given to apt, the others are dependencies
+    :return: the installed, upgraded and removed packages, largest growth first
+    """
+    # apt accepts pkg:arch and pkg=version
+    names = {p.split("=")[0].split(":")[0] for p in requested}
+
+    changes: List[Dict[str, Any]] = list()
+    for package in before.keys() | after.keys():
+        growth = after.get(package, 0) - before.get(package, 0)
+        if package in before and package in after and growth == 0:
+            continue
+        changes.append(
+            {
+                "package": package,
+                "requested": package.split(":")[0] in names,
+                "installed_size": after.get(package, 0),
+                "growth": growth,
+            }
+        )
+
+    changes.sort(key=lambda c: (-c["growth"], c["package"]))
+    return changes
+
+
+class Telemetry:
+    """
+    Sample the block statistics of the loop device, the usage of the mounted
+    root filesystem and the allocated size of the image file at each stage
+    boundary of a build.
+    File descriptors are opened upfront so sampling keeps working while the
+    genesis process is in the chroot.
+    """
+
+    loop_device: str
+    image_fd: int
+    stat_fd: int
+    mount_fd: int
+    stages: List[Dict[str, Any]]
+    open_stages: List[str]
+    packages: List[Dict[str, Any]]
+
+    def __init__(self, image_path: str, loop_device: str, mount_dir: str) -> None:
+        self.loop_device = loop_device
+        self.image_fd = os.open(image_path, os.O_RDONLY)
+        self.stat_fd = os.open(f"/sys/block/{loop_device}/stat", os.O_RDONLY)
+        self.mount_fd = os.open(mount_dir, os.O_RDONLY | os.O_DIRECTORY)
+        self.stages = list()
+        self.open_stages = list()
+        self.packages = list()
+
+    def sample(self) -> Sample:
+        # make sure the data written during the stage reached the loop device
+        os.sync()
+
+        # see Documentation/block/stat.rst in the kernel tree
+        fields = [int(f) for f in os.pread(self.stat_fd, 4096, 0).split()]
+        fs = os.statvfs(self.mount_fd)
+
+        return Sample(
+            time=time.monotonic(),
+            read_ios=fields[0],
+            read_bytes=fields[2] * SECTOR_SIZE,
+            write_ios=fields[4],
+            write_bytes=fields[6] * SECTOR_SIZE,
+            fs_used=(fs.f_blocks - fs.f_bfree) * fs.f_frsize,
+            image_allocated=os.fstat(self.image_fd).st_blocks * SECTOR_SIZE,
+        )
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Measure a stage. Stages can be nested, a nested stage is also
+        accounted in its parent so only stages of depth 0 add up to the
+        totals.
+        """
+        parent = self.open_stages[-1] if self.open_stages else None
+        depth = len(self.open_stages)
+        # keep the parent before its nested stages in the report
+        position = len(self.stages)
+
+        self.open_stages.append(name)
+        before = self.sample()
+        try:
+            yield
+        finally:
+            self.open_stages.pop()
+        after = self.sample()
+
+        duration = after.time - before.time
+        ios = (after.read_ios - before.read_ios) + (after.write_ios - before.write_ios)
+        self.stages.insert(
+            position,
+            {
+                "stage": name,
+                "parent": parent,
+                "depth": depth,
+                "duration": duration,
+                "read_bytes": after.read_bytes - before.read_bytes,
+                "write_bytes": after.write_bytes - before.write_bytes,
+                "read_ios": after.read_ios - before.read_ios,
+                "write_ios": after.write_ios - before.write_ios,
+                "iops": ios / duration if duration > 0 else 0.0,
+                "fs_growth": after.fs_used - before.fs_used,
+                "image_growth": after.image_allocated - before.image_allocated,
+                "fs_used": after.fs_used,
+                "image_allocated": after.image_allocated,
+            },
+        )
+
+    def add_packages(self, changes: List[Dict[str, Any]]) -> None:
+        """
+        Record the packages installed by the current stage.
+        """
+        stage = self.open_stages[-1] if self.open_stages else None
+        self.packages.extend(dict(c, stage=stage) for c in changes)
+
+    def report(self) -> str:
+        mb = 1024 * 1024
+        lines = [
+            f"{'STAGE':<40} {'TIME(s)':>8} {'READ(MB)':>9} {'WRITE(MB)':>10} "
+            f"{'IOPS':>8} {'FS+(MB)':>9} {'IMG+(MB)':>9}"
+        ]
+        for s in self.stages:
+            name = "  " * s["depth"] + s["stage"]
+            lines.append(
+                f"{name:<40} {s['duration']:>8.1f} {s['read_bytes'] / mb:>9.1f} "
+                f"{s['write_bytes'] / mb:>10.1f} {s['iops']:>8.0f} "
+                f"{s['fs_growth'] / mb:>9.1f} {s['image_growth'] / mb:>9.1f}"
+            )
+
+        # nested stages are already accounted in their parent
+        top = [s for s in self.stages if s["depth"] == 0]
+        lines.append(
+            f"{'TOTAL':<40} {sum(s['duration'] for s in top):>8.1f} "
+            f"{sum(s['read_bytes'] for s in top) / mb:>9.1f} "
+            f"{sum(s['write_bytes'] for s in top) / mb:>10.1f} {'':>8} "
+            f"{sum(s['fs_growth'] for s in top) / mb:>9.1f} "
+            f"{sum(s['image_growth'] for s in top) / mb:>9.1f}"
+        )
+
+        if self.packages:
+            lines.append("")
+            lines.append(f"{'PACKAGE':<40} {'SIZE(MB)':>9} {'GROWTH(MB)':>11}")
+            for p in self.packages:
+                # packages pulled in as dependencies are indented
+                name = p["package"] if p["requested"] else "  " + p["package"]
+                lines.append(
+                    f"{name:<40} {p['installed_size'] / mb:>9.1f} {p['growth'] / mb:>11.1f}"
+                )
+
+        return "\n".join(lines)
+
+    def save(self, path: str) -> None:
+        """
+        Append the stages and packages to a JSON file, so that several genesis
+        commands building the same image can share the same file.
+        """
+        stages: List[Dict[str, Any]] = list()
+        packages: List[Dict[str, Any]] = list()
+        if os.path.exists(path):
+            with open(path) as telemetry_file:
+                previous = json.load(telemetry_file)
+            stages = previous.get("stages", list())
+            packages = previous.get("packages", list())
+
+        stages.extend(self.stages)
+        packages.extend(self.packages)
+        with open(path, "w") as telemetry_file:
+            json.dump({"stages": stages, "packages": packages}, telemetry_file, indent=2)
+
+    def close(self) -> None:
+        os.close(self.image_fd)
+        os.close(self.stat_fd)
+        os.close(self.mount_fd)
+
+
+output_path: Optional[str] = None
+current: Optional[Telemetry] = None
+
+
+def configure(path: Optional[str]) -> None:
+    global output_path
+    output_path = os.path.abspath(path) if path is not None else None
+
+
+def enabled() -> bool:
+    return output_path is not None
+
+
+def attach(image_path: str, loop_device: str, mount_dir: str) -> None:
+    """
+    Start collecting telemetry for an image (only if a telemetry output
+    has been configured).
+    """
+    global current
+    if enabled():
+        current = Telemetry(image_path, loop_device, mount_dir)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    if current is None:
+        yield
+        return
+
+    with current.stage(name):
+        yield
+
+
+def packages(before: Dict[str, int], after: Dict[str, int], requested: List[str]) -> None:
+    """
+    Record what the installation of packages cost, from snapshots of the
+    dpkg database taken before and after it.
+    """
+    if current is not None:
+        current.add_packages(package_changes(before, after, requested))
+
+
+def detach() -> None:
+    """
+    Print the report and save it. This must be called before unmounting
+    the image.
+    """
+    global current
+    if current is None:
+        return
+
+    print(current.report())
+    assert output_path is not None
+    current.save(output_path)
+    current.close()
+    current = None
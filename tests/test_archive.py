@@ -0,0 +1,253 @@
+import gzip
+import hashlib
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+import requests
+
+import genesis.archive as archive
+import genesis.bootstrap as bootstrap
+
+PACKAGES = """Package: base-files
+Version: 13ubuntu10
+Priority: required
+Essential: yes
+Depends: libc6 (>= 2.34)
+
+Package: libc6
+Version: 2.39-0ubuntu8
+Priority: optional
+Depends: libgcc-s1
+Recommends: locales
+
+Package: libc6
+Version: 2.39-0ubuntu2
+Priority: optional
+
+Package: libgcc-s1
+Version: 14-20240412-0ubuntu1
+Priority: optional
+Provides: libgcc1 (= 1:14-20240412-0ubuntu1)
+
+Package: locales
+Version: 2.39-0ubuntu8
+Priority: optional
+
+Package: mawk
+Version: 1.3.4.20240123-1build1
+Priority: required
+Provides: awk
+
+Package: needs-awk
+Version: 1.0
+Depends: awk, libgcc1:any | gcc-runtime
+
+Package: broken
+Version: 1.0
+Depends: does-not-exist (>= 1.0) | also-missing
+Recommends: not-there-either
+"""
+
+
+@pytest.mark.parametrize(
+    "a,b,expected",
+    [
+        ("1.0", "1.0", 0),
+        ("1.0", "1.1", -1),
+        ("1.10", "1.9", 1),
+        ("1.0~rc1", "1.0", -1),
+        ("1.0", "1.0+build1", -1),
+        ("1:0.1", "2.0", 1),
+        ("2.39-0ubuntu8", "2.39-0ubuntu10", -1),
+        ("2.39-0ubuntu8", "2.39", 1),
+        ("1.0a", "1.0-1", 1),
+        ("1.0~~", "1.0~", -1),
+    ],
+)
+def test_version_compare(a: str, b: str, expected: int) -> None:
+    result = archive.version_compare(a, b)
+    assert (result > 0) - (result < 0) == expected
+
+
+def test_parse_relations() -> None:
+    relations = archive.parse_relations(
+        "libc6 (>= 2.34), debconf (>= 0.5) | debconf-2.0, python3:any, foo [amd64] <!nocheck>,"
+    )
+    assert relations == [["libc6"], ["debconf", "debconf-2.0"], ["python3"], ["foo"]]
+    assert archive.parse_relations("") == []
+
+
+def load_index() -> archive.PackageIndex:
+    index = archive.PackageIndex()
+    index.add_index(PACKAGES)
+    return index
+
+
+def test_highest_version_is_kept() -> None:
+    assert load_index().packages["libc6"]["Version"] == "2.39-0ubuntu8"
+
+
+def test_resolve() -> None:
+    index = load_index()
+
+    packages, missing = index.resolve(index.by_priority(["required"]))
+    assert sorted(packages) == ["base-files", "libc6", "libgcc-s1", "mawk"]
+    assert missing == {}
+
+    packages, _ = index.resolve(["base-files"], recommends=True)
+    assert "locales" in packages
+
+
+def test_resolve_virtual_packages() -> None:
+    packages, missing = load_index().resolve(["needs-awk"])
+    assert sorted(packages) == ["libgcc-s1", "mawk", "needs-awk"]
+    assert missing == {}
+
+
+def test_resolve_missing() -> None:
+    packages, missing = load_index().resolve(["broken", "unknown"], recommends=True)
+    assert packages == ["broken"]
+    assert missing == {"does-not-exist | also-missing": "broken", "unknown": ""}
+
+
+def write_release(dists: Path, files: Dict[str, bytes]) -> bytes:
+    lines = ["Suite: noble", "Codename: noble", "SHA256:"]
+    for path, content in files.items():
+        lines.append(f" {hashlib.sha256(content).hexdigest()} {len(content)} {path}")
+    release = ("\n".join(lines) + "\n").encode()
+
+    (dists / "Release").write_bytes(release)
+    return release
+
+
+def create_mirror(root: Path) -> Path:
+    """
+    Create a file:// mirror with a single suite (noble) and component (main).
+    """
+    dists = root / "dists" / "noble"
+    binary = dists / "main" / "binary-amd64"
+    binary.mkdir(parents=True)
+
+    packages = gzip.compress(PACKAGES.encode())
+    (binary / "Packages.gz").write_bytes(packages)
+    write_release(dists, {"main/binary-amd64/Packages.gz": packages})
+
+    return dists
+
+
+def test_fetch_packages(tmp_path: Path) -> None:
+    create_mirror(tmp_path)
+    session = requests.Session()
+    mirror = f"file://{tmp_path}"
+
+    release = archive.fetch_release(mirror, "noble", session, keyring=None)
+    content = archive.fetch_packages(mirror, "noble", "main", "amd64", release, session)
+
+    assert content == PACKAGES
+
+
+def test_fetch_packages_checksum_mismatch(tmp_path: Path) -> None:
+    dists = create_mirror(tmp_path)
+    session = requests.Session()
+    mirror = f"file://{tmp_path}"
+
+    release = archive.fetch_release(mirror, "noble", session, keyring=None)
+    (dists / "main" / "binary-amd64" / "Packages.gz").write_bytes(
+        gzip.compress(PACKAGES.replace("13ubuntu10", "13ubuntu11").encode())
+    )
+
+    with pytest.raises(RuntimeError, match="does not match"):
+        archive.fetch_packages(mirror, "noble", "main", "amd64", release, session)
+
+
+def test_host_architecture(monkeypatch) -> None:
+    monkeypatch.setattr(bootstrap, "machine", lambda: "aarch64")
+    assert bootstrap.host_architecture() == "arm64"
+
+    monkeypatch.setattr(bootstrap, "machine", lambda: "mips")
+    with pytest.raises(ValueError):
+        bootstrap.host_architecture()
+
+
+def gpg(home: Path, args: List[str]) -> None:
+    subprocess.run(
+        ["gpg", "--batch", "--quiet", "--homedir", str(home)] + args,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def create_keyring(home: Path, keyring: Path) -> None:
+    home.mkdir(mode=0o700)
+    gpg(home, ["--passphrase", "", "--quick-gen-key", "Archive <archive@test>", "ed25519"])
+    gpg(home, ["--output", str(keyring), "--export"])
+
+
+@pytest.fixture
+def signed_mirror(tmp_path: Path):
+    """
+    A mirror signed with a throwaway key.
+    :return: the mirror, the keyring and the gpg home used to sign
+    """
+    if shutil.which("gpg") is None or shutil.which("gpgv") is None:
+        pytest.skip("gpg is not installed")
+
+    home = tmp_path / "gnupg"
+    keyring = tmp_path / "keyring.gpg"
+    create_keyring(home, keyring)
+
+    dists = create_mirror(tmp_path / "mirror")
+    gpg(home, ["--clearsign", "--output", str(dists / "InRelease"), str(dists / "Release")])
+
+    return tmp_path / "mirror", keyring, home
+
+
+def test_fetch_release_inline_signature(signed_mirror) -> None:
+    mirror, keyring, _ = signed_mirror
+
+    release = archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(keyring))
+    assert "main/binary-amd64/Packages.gz" in release.sha256
+
+
+def test_fetch_release_tampered(signed_mirror) -> None:
+    mirror, keyring, _ = signed_mirror
+    in_release = mirror / "dists" / "noble" / "InRelease"
+    in_release.write_text(in_release.read_text().replace("Suite: noble", "Suite: evil"))
+
+    with pytest.raises(RuntimeError, match="signature verification failed"):
+        archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(keyring))
+
+
+def test_fetch_release_unknown_key(signed_mirror, tmp_path: Path) -> None:
+    mirror, _, _ = signed_mirror
+    other_keyring = tmp_path / "other.gpg"
+    create_keyring(tmp_path / "other-gnupg", other_keyring)
+
+    with pytest.raises(RuntimeError, match="signature verification failed"):
+        archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(other_keyring))
+
+
+def test_fetch_release_detached_signature(signed_mirror) -> None:
+    mirror, keyring, home = signed_mirror
+    dists = mirror / "dists" / "noble"
+    (dists / "InRelease").unlink()
+    gpg(home, ["--detach-sign", "--output", str(dists / "Release.gpg"), str(dists / "Release")])
+
+    release = archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(keyring))
+    assert "main/binary-amd64/Packages.gz" in release.sha256
+
+    (dists / "Release").write_bytes((dists / "Release").read_bytes() + b"Label: evil\n")
+    with pytest.raises(RuntimeError, match="signature verification failed"):
+        archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(keyring))
+
+
+def test_fetch_release_unsigned(signed_mirror) -> None:
+    mirror, keyring, _ = signed_mirror
+    (mirror / "dists" / "noble" / "InRelease").unlink()
+
+    with pytest.raises(FileNotFoundError):
+        archive.fetch_release(f"file://{mirror}", "noble", requests.Session(), str(keyring))
@@ -0,0 +1,124 @@
+import errno
+import os
+import shutil
+import struct
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import genesis.compress as compress
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def sparse_image(tmp_path: Path) -> Path:
+    """
+    A sparse image of 2.5 frames with data in the first and the last frame.
+    """
+    path = tmp_path / "disk.img"
+    with open(path, "wb") as f:
+        f.truncate(2 * compress.FRAME_SIZE + compress.FRAME_SIZE // 2)
+        f.write(b"genesis" * 1000)
+        f.seek(2 * compress.FRAME_SIZE + MIB)
+        f.write(os.urandom(MIB))
+
+    return path
+
+
+def lseek_error(code: int):
+    def lseek(fd: int, offset: int, whence: int) -> int:
+        raise OSError(code, os.strerror(code))
+
+    return lseek
+
+
+def test_is_hole(sparse_image: Path) -> None:
+    fd = os.open(sparse_image, os.O_RDONLY)
+    try:
+        assert not compress.is_hole(fd, 0, compress.FRAME_SIZE)
+        assert not compress.is_hole(fd, 2 * compress.FRAME_SIZE, compress.FRAME_SIZE // 2)
+        # only meaningful if the filesystem of the test keeps the file sparse
+        if os.stat(sparse_image).st_blocks * 512 < compress.FRAME_SIZE:
+            assert compress.is_hole(fd, compress.FRAME_SIZE, compress.FRAME_SIZE)
+    finally:
+        os.close(fd)
+
+
+def test_is_hole_errors(monkeypatch) -> None:
+    monkeypatch.setattr(os, "lseek", lseek_error(errno.ENXIO))
+    assert compress.is_hole(0, 0, MIB)
+
+    # SEEK_DATA not supported: the data must be read
+    monkeypatch.setattr(os, "lseek", lseek_error(errno.EINVAL))
+    assert not compress.is_hole(0, 0, MIB)
+
+    monkeypatch.setattr(os, "lseek", lseek_error(errno.EIO))
+    with pytest.raises(OSError):
+        compress.is_hole(0, 0, MIB)
+
+
+def decompress(cmd: str, path: Path) -> bytes:
+    if shutil.which(cmd) is None:
+        pytest.skip(f"{cmd} is not installed")
+
+    return subprocess.run([cmd, "-d", "-c", str(path)], stdout=subprocess.PIPE, check=True).stdout
+
+
+def test_zstd_round_trip(sparse_image: Path, tmp_path: Path) -> None:
+    if shutil.which("zstd") is None:
+        pytest.skip("zstd is not installed")
+    out = tmp_path / "disk.img.zst"
+
+    compress.compress_image(str(sparse_image), "zstd", str(out))
+
+    assert decompress("zstd", out) == sparse_image.read_bytes()
+
+
+def test_zstd_seek_table(sparse_image: Path, tmp_path: Path) -> None:
+    if shutil.which("zstd") is None:
+        pytest.skip("zstd is not installed")
+    out = tmp_path / "disk.img.zst"
+
+    compress.compress_image(str(sparse_image), "zstd", str(out))
+    content = out.read_bytes()
+
+    num_frames, descriptor, magic = struct.unpack("<IBI", content[-9:])
+    assert magic == compress.ZSTD_SEEKABLE_MAGIC
+    assert descriptor == 0
+    assert num_frames == 3
+
+    table_size = num_frames * 8 + 9
+    skippable = content[-table_size - 8 :]
+    skippable_magic, frame_size = struct.unpack_from("<II", skippable)
+    assert skippable_magic == compress.ZSTD_SKIPPABLE_MAGIC
+    assert frame_size == table_size
+
+    entries = [struct.unpack_from("<II", skippable, 8 + i * 8) for i in range(num_frames)]
+    assert [d for _, d in entries] == [
+        compress.FRAME_SIZE,
+        compress.FRAME_SIZE,
+        compress.FRAME_SIZE // 2,
+    ]
+    assert sum(c for c, _ in entries) == len(content) - len(skippable)
+
+    # every frame can be decompressed on its own
+    offset = 0
+    image = sparse_image.read_bytes()
+    for i, (c_size, d_size) in enumerate(entries):
+        frame = tmp_path / f"frame{i}.zst"
+        frame.write_bytes(content[offset : offset + c_size])
+        start = i * compress.FRAME_SIZE
+        assert decompress("zstd", frame) == image[start : start + d_size]
+        offset += c_size
+
+
+def test_xz_round_trip(sparse_image: Path, tmp_path: Path) -> None:
+    if shutil.which("xz") is None:
+        pytest.skip("xz is not installed")
+    out = tmp_path / "disk.img.xz"
+
+    compress.compress_image(str(sparse_image), "xz", str(out))
+
+    assert decompress("xz", out) == sparse_image.read_bytes()
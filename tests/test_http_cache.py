@@ -0,0 +1,198 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List
+
+import pytest
+import requests
+
+from genesis.http_cache import HTTPCache
+
+PINNED_PATH = "/raw/8df1830c1ce6aa80b23515d9420c9afdc987ee1d/file.cfg"
+
+
+class Server:
+    """
+    Stand-in for a remote server: serves a single body and records the
+    requests it receives.
+    """
+
+    body: bytes
+    etag: str
+    status: int
+    cache_control: str
+    truncated: bool
+    requests: List[Dict[str, Any]]
+    url: str
+
+    def __init__(self, port: int) -> None:
+        self.body = b"content"
+        self.etag = '"v1"'
+        self.status = 200
+        self.cache_control = ""
+        self.truncated = False
+        self.requests = list()
+        self.url = f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+def server() -> Iterator[Server]:
+    state: Dict[str, Server] = dict()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            s = state["server"]
+            s.requests.append({"path": self.path, "headers": dict(self.headers)})
+
+            if s.status != 200:
+                self.send_response(s.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if self.headers.get("If-None-Match") == s.etag:
+                self.send_response(304)
+                self.send_header("ETag", s.etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("ETag", s.etag)
+            # a truncated response announces more than it sends
+            length = len(s.body) + (1024 if s.truncated else 0)
+            self.send_header("Content-Length", str(length))
+            if s.cache_control != "":
+                self.send_header("Cache-Control", s.cache_control)
+            self.end_headers()
+            self.wfile.write(s.body)
+            if s.truncated:
+                self.close_connection = True
+
+        def log_message(self, *args) -> None:
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    state["server"] = Server(httpd.server_address[1])
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield state["server"]
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_and_revalidate(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    url = f"{server.url}/file.cfg"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    assert read(tmp_path / "first") == b"content"
+
+    cache.fetch(url, str(tmp_path / "second"))
+    assert read(tmp_path / "second") == b"content"
+    assert len(server.requests) == 2
+    assert server.requests[1]["headers"]["If-None-Match"] == '"v1"'
+
+
+def test_changed_content(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    url = f"{server.url}/file.cfg"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    server.body = b"new content"
+    server.etag = '"v2"'
+    cache.fetch(url, str(tmp_path / "second"))
+
+    assert read(tmp_path / "second") == b"new content"
+
+
+def test_fresh_entry(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    server.cache_control = "max-age=3600"
+    url = f"{server.url}/file.cfg"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    cache.fetch(url, str(tmp_path / "second"))
+
+    assert read(tmp_path / "second") == b"content"
+    assert len(server.requests) == 1
+
+
+def test_pinned_url(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    url = f"{server.url}{PINNED_PATH}"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    cache.fetch(url, str(tmp_path / "second"))
+
+    assert read(tmp_path / "second") == b"content"
+    assert len(server.requests) == 1
+
+
+def test_server_error_serves_cached_copy(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    url = f"{server.url}/file.cfg"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    server.status = 503
+    cache.fetch(url, str(tmp_path / "second"))
+
+    assert read(tmp_path / "second") == b"content"
+
+
+def test_server_error_without_cached_copy(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    server.status = 503
+
+    with pytest.raises(requests.HTTPError):
+        cache.fetch(f"{server.url}/file.cfg", str(tmp_path / "file"))
+
+
+def test_client_error_is_not_hidden(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    url = f"{server.url}/file.cfg"
+
+    cache.fetch(url, str(tmp_path / "first"))
+    server.status = 404
+
+    with pytest.raises(requests.HTTPError):
+        cache.fetch(url, str(tmp_path / "second"))
+
+
+def test_offline(server: Server, tmp_path) -> None:
+    url = f"{server.url}/file.cfg"
+    HTTPCache(str(tmp_path / "cache")).fetch(url, str(tmp_path / "first"))
+
+    offline_cache = HTTPCache(str(tmp_path / "cache"), offline=True)
+    offline_cache.fetch(url, str(tmp_path / "second"))
+    assert read(tmp_path / "second") == b"content"
+    assert len(server.requests) == 1
+
+    with pytest.raises(RuntimeError):
+        offline_cache.fetch(f"{server.url}/other.cfg", str(tmp_path / "other"))
+
+
+def test_eviction(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"), max_size=len(b"content"))
+
+    cache.fetch(f"{server.url}/a.cfg", str(tmp_path / "a"))
+    cache.fetch(f"{server.url}/b.cfg", str(tmp_path / "b"))
+
+    assert cache.load_metadata(f"{server.url}/a.cfg") is None
+    assert cache.load_metadata(f"{server.url}/b.cfg") is not None
+
+
+def test_interrupted_download(server: Server, tmp_path) -> None:
+    cache = HTTPCache(str(tmp_path / "cache"))
+    server.truncated = True
+
+    with pytest.raises(requests.RequestException):
+        cache.fetch(f"{server.url}/file.cfg", str(tmp_path / "file"))
+
+    assert os.listdir(tmp_path / "cache") == []
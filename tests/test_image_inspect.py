@@ -0,0 +1,348 @@
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+from genesis.image_inspect import (
+    ESP_GUID,
+    LINUX_FILESYSTEM_GUID,
+    SECTOR_SIZE,
+    DiskImage,
+    Ext4,
+    Vfat,
+    inspect_image,
+)
+
+FAT_RESERVED_SECTORS = 32
+FAT_TOTAL_SECTORS = 70000
+# enough clusters (one sector each) to be a FAT32 filesystem
+FAT_SIZE = (FAT_TOTAL_SECTORS * 4 + SECTOR_SIZE - 1) // SECTOR_SIZE
+FAT_DATA_SECTOR = FAT_RESERVED_SECTORS + 2 * FAT_SIZE
+END_OF_CHAIN = 0x0FFFFFFF
+
+GRUB_CFG = b"search.fs_uuid 1234 root\nconfigfile ($root)/boot/grub/grub.cfg\n"
+# spans several clusters
+SHIM = bytes(range(256)) * 7
+
+ESP_FILES = {
+    "EFI/ubuntu/grub.cfg": GRUB_CFG,
+    "EFI/BOOT/BOOTX64.EFI": SHIM,
+    "EFI/BOOT/mmx64.efi": b"mm",
+    "EFI/ubuntu/a file with a long name.txt": b"long name",
+}
+
+KERNEL = "6.8.0-31-generic"
+
+
+def short_name(name: str, index: int) -> Tuple[bytes, int, bool]:
+    """
+    :return: the 8.3 name, the case flags and whether a long name is needed
+    """
+    base, _, ext = name.rpartition(".") if "." in name else (name, "", "")
+    fits = 0 < len(base) <= 8 and len(ext) <= 3 and " " not in name and name.count(".") <= 1
+    if fits and name == name.upper():
+        return f"{base:<8}{ext:<3}".encode(), 0, False
+    if fits and name == name.lower():
+        # no long name needed, like Linux does for lowercase 8.3 names
+        flags = 0x08 | (0x10 if ext else 0)
+        return f"{base.upper():<8}{ext.upper():<3}".encode(), flags, False
+
+    alias = f"{base[:6].upper().replace(' ', '')}~{index}"
+    return f"{alias:<8}{ext[:3].upper():<3}".encode(), 0, True
+
+
+def lfn_checksum(name: bytes) -> int:
+    checksum = 0
+    for c in name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    return checksum
+
+
+def dir_entry(name: str, index: int, cluster: int, size: int, is_dir: bool) -> bytes:
+    if name in (".", ".."):
+        short, flags, needs_lfn = f"{name:<11}".encode(), 0, False
+    else:
+        short, flags, needs_lfn = short_name(name, index)
+
+    entries = b""
+    if needs_lfn:
+        chars = name.encode("utf-16-le") + b"\0\0"
+        chars += b"\xff" * (-len(chars) % 26)
+        parts = [chars[i : i + 26] for i in range(0, len(chars), 26)]
+        for seq in range(len(parts), 0, -1):
+            part = parts[seq - 1]
+            entries += (
+                bytes([seq | (0x40 if seq == len(parts) else 0)])
+                + part[0:10]
+                + bytes([0x0F, 0, lfn_checksum(short)])
+                + part[10:22]
+                + b"\0\0"
+                + part[22:26]
+            )
+
+    attr = 0x10 if is_dir else 0x20
+    entries += short + struct.pack(
+        "<BBBHHHHHHHI", attr, flags, 0, 0, 0, 0, cluster >> 16, 0, 0, cluster & 0xFFFF, size
+    )
+    return entries
+
+
+def make_fat32(path: Path, files: Dict[str, bytes]) -> None:
+    """
+    Create a FAT32 filesystem laid out like the ones created by mkfs.fat
+    (notably with a non zero number of sectors per track).
+    """
+    fat: Dict[int, int] = {0: 0x0FFFFFF8, 1: END_OF_CHAIN}
+    clusters: Dict[int, bytes] = dict()
+    next_cluster = [2]
+
+    def allocate(data: bytes) -> int:
+        count = max(1, (len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE)
+        first = next_cluster[0]
+        for i in range(count):
+            c = first + i
+            fat[c] = c + 1 if i < count - 1 else END_OF_CHAIN
+            clusters[c] = data[i * SECTOR_SIZE : (i + 1) * SECTOR_SIZE]
+        next_cluster[0] += count
+        return first
+
+    tree: Dict[str, Any] = dict()
+    for file_path, content in files.items():
+        node = tree
+        *dirs, name = file_path.split("/")
+        for d in dirs:
+            node = node.setdefault(d, dict())
+        node[name] = content
+
+    def write_dir(node: dict, parent: int, is_root: bool) -> int:
+        # reserve the first cluster so "." can point to it
+        first = allocate(b"")
+        entries = b""
+        if not is_root:
+            entries += dir_entry(".", 0, first, 0, True)
+            entries += dir_entry("..", 0, parent, 0, True)
+
+        for index, (name, child) in enumerate(node.items(), start=1):
+            if isinstance(child, dict):
+                cluster = write_dir(child, 0 if is_root else first, False)
+                entries += dir_entry(name, index, cluster, 0, True)
+            else:
+                cluster = allocate(child)
+                entries += dir_entry(name, index, cluster, len(child), False)
+
+        # chain the directory clusters after the first one
+        clusters[first] = entries[:SECTOR_SIZE]
+        previous = first
+        for i in range(SECTOR_SIZE, len(entries), SECTOR_SIZE):
+            c = allocate(entries[i : i + SECTOR_SIZE])
+            fat[previous] = c
+            previous = c
+        return first
+
+    root_cluster = write_dir(tree, 0, True)
+    assert root_cluster == 2
+
+    bpb = bytearray(SECTOR_SIZE)
+    bpb[0:11] = b"\xebX\x90mkfs.fat"
+    struct.pack_into(
+        "<HBHBHHBHHHIIIHHIHH",
+        bpb,
+        11,
+        SECTOR_SIZE,
+        1,
+        FAT_RESERVED_SECTORS,
+        2,
+        0,
+        0,
+        0xF8,
+        0,
+        32,
+        8,
+        0,
+        FAT_TOTAL_SECTORS,
+        FAT_SIZE,
+        0,
+        0,
+        root_cluster,
+        1,
+        6,
+    )
+    bpb[66] = 0x29
+    bpb[71:90] = b"ESP        FAT32   "
+    bpb[510:512] = b"\x55\xaa"
+
+    fat_table = bytearray(FAT_SIZE * SECTOR_SIZE)
+    for c, value in fat.items():
+        struct.pack_into("<I", fat_table, c * 4, value)
+
+    with open(path, "wb") as f:
+        f.truncate(FAT_TOTAL_SECTORS * SECTOR_SIZE)
+        f.write(bpb)
+        for i in range(2):
+            f.seek((FAT_RESERVED_SECTORS + i * FAT_SIZE) * SECTOR_SIZE)
+            f.write(fat_table)
+        for c, data in clusters.items():
+            f.seek((FAT_DATA_SECTOR + c - 2) * SECTOR_SIZE)
+            f.write(data)
+
+
+def make_ext4(path: Path, root: Path) -> None:
+    if shutil.which("mkfs.ext4") is None:
+        pytest.skip("mkfs.ext4 is not installed")
+
+    (root / "etc").mkdir(parents=True)
+    (root / "etc" / "hostname").write_text("genesis\n")
+    (root / "boot" / "efi").mkdir(parents=True)
+    (root / "boot" / f"vmlinuz-{KERNEL}").write_bytes(os.urandom(3 * 1024 * 1024))
+    (root / "boot" / "vmlinuz").symlink_to(f"vmlinuz-{KERNEL}")
+    (root / "usr" / "share" / "doc").mkdir(parents=True)
+    for i in range(500):
+        (root / "usr" / "share" / "doc" / f"package-{i}").mkdir()
+    (root / "usr" / "bin").mkdir()
+    (root / "usr" / "bin" / "python3").write_text("#!/bin/true\n")
+    (root / "bin").symlink_to("usr/bin")
+    (root / "etc" / "alternatives").mkdir()
+    (root / "etc" / "alternatives" / "python").symlink_to("/bin/python3")
+    long_target = "/usr/share/doc/" + "x" * 80
+    (root / "etc" / "long-link").symlink_to(long_target)
+
+    subprocess.run(
+        ["mkfs.ext4", "-q", "-F", "-L", "rootfs", "-d", str(root), str(path), "64M"],
+        check=True,
+    )
+
+
+def copy_into(src: Path, image, offset: int) -> None:
+    with open(src, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            if chunk.count(0) != len(chunk):
+                image.seek(offset)
+                image.write(chunk)
+            offset += len(chunk)
+
+
+def make_disk(path: Path, partitions: List[Tuple[uuid.UUID, str, Path]]) -> None:
+    """
+    Create a GPT disk image holding the given filesystem images.
+    """
+    entries_lba = 2
+    first_lba = 2048
+    table = bytearray(128 * 128)
+
+    with open(path, "wb") as image:
+        for i, (type_guid, name, fs_image) in enumerate(partitions):
+            sectors = (os.path.getsize(fs_image) + SECTOR_SIZE - 1) // SECTOR_SIZE
+            last_lba = first_lba + sectors - 1
+            table[i * 128 : (i + 1) * 128] = (
+                type_guid.bytes_le
+                + uuid.uuid4().bytes_le
+                + struct.pack("<QQQ", first_lba, last_lba, 0)
+                + name.encode("utf-16-le").ljust(72, b"\0")
+            )
+            copy_into(fs_image, image, first_lba * SECTOR_SIZE)
+            first_lba = last_lba + 1 + 2047 & ~2047
+
+        header = bytearray(SECTOR_SIZE)
+        header[0:8] = b"EFI PART"
+        struct.pack_into("<QII", header, 0x48, entries_lba, 128, 128)
+        image.seek(SECTOR_SIZE)
+        image.write(header)
+        image.seek(entries_lba * SECTOR_SIZE)
+        image.write(table)
+        image.truncate((first_lba + 34) * SECTOR_SIZE)
+
+
+def open_mmap(path: Path) -> mmap.mmap:
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@pytest.fixture
+def esp_image(tmp_path: Path) -> Path:
+    path = tmp_path / "esp.img"
+    make_fat32(path, ESP_FILES)
+    return path
+
+
+@pytest.fixture
+def rootfs_image(tmp_path: Path) -> Path:
+    path = tmp_path / "rootfs.img"
+    make_ext4(path, tmp_path / "rootfs")
+    return path
+
+
+@pytest.fixture
+def disk_image(tmp_path: Path, esp_image: Path, rootfs_image: Path) -> Path:
+    path = tmp_path / "disk.img"
+    make_disk(
+        path, [(ESP_GUID, "ESP", esp_image), (LINUX_FILESYSTEM_GUID, "rootfs", rootfs_image)]
+    )
+    return path
+
+
+def test_vfat_layout(esp_image: Path) -> None:
+    fs = Vfat(open_mmap(esp_image), 0)
+
+    assert fs.fat32
+    assert fs.root_cluster == 2
+    assert fs.fat_offset == FAT_RESERVED_SECTORS * SECTOR_SIZE
+    assert fs.data_offset == FAT_DATA_SECTOR * SECTOR_SIZE
+
+
+def test_vfat_read(esp_image: Path) -> None:
+    fs = Vfat(open_mmap(esp_image), 0)
+
+    assert fs.read_file("/EFI/ubuntu/grub.cfg") == GRUB_CFG
+    assert fs.read_file("/efi/boot/bootx64.efi") == SHIM
+    assert fs.read_file("/EFI/ubuntu/a file with a long name.txt") == b"long name"
+    assert fs.list_dir("/EFI") == ["BOOT", "ubuntu"]
+    assert fs.list_dir("/EFI/BOOT") == ["BOOTX64.EFI", "mmx64.efi"]
+
+    with pytest.raises(FileNotFoundError):
+        fs.read_file("/EFI/ubuntu/shimx64.efi")
+    with pytest.raises(IsADirectoryError):
+        fs.read_file("/EFI")
+
+
+def test_ext4_read(rootfs_image: Path, tmp_path: Path) -> None:
+    fs = Ext4(open_mmap(rootfs_image), 0)
+
+    assert fs.read_file("/etc/hostname") == b"genesis\n"
+    kernel = (tmp_path / "rootfs" / "boot" / f"vmlinuz-{KERNEL}").read_bytes()
+    assert fs.read_file("/boot/vmlinuz") == kernel
+    assert fs.read_file("/etc/alternatives/python") == b"#!/bin/true\n"
+    assert fs.readlink(fs.lookup("/etc/long-link", follow=False)) == "/usr/share/doc/" + "x" * 80
+    assert len(fs.list_dir("/usr/share/doc")) == 500
+    assert "package-499" in fs.list_dir("/usr/share/doc")
+
+    with pytest.raises(FileNotFoundError):
+        fs.read_file("/etc/missing")
+    with pytest.raises(NotADirectoryError):
+        fs.list_dir("/etc/hostname")
+
+
+def test_disk_image(disk_image: Path) -> None:
+    with DiskImage(str(disk_image)) as image:
+        assert [p.name for p in image.partitions] == ["ESP", "rootfs"]
+        assert image.read_file("/boot/efi/EFI/ubuntu/grub.cfg") == GRUB_CFG
+        assert image.list_dir("/boot/efi") == ["EFI"]
+        assert image.read_file("/etc/hostname") == b"genesis\n"
+        assert image.kernel_versions() == [KERNEL]
+
+
+def test_inspect_image(disk_image: Path) -> None:
+    out = inspect_image(str(disk_image), ["/boot/efi/EFI/ubuntu/grub.cfg"], ["/etc"], True)
+
+    assert f"kernel: {KERNEL}" in out
+    assert "configfile ($root)/boot/grub/grub.cfg" in out
+    assert "hostname" in out
+    assert "ERROR" not in out
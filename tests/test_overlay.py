@@ -0,0 +1,172 @@
+import os
+import shutil
+import stat
+import tarfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+import genesis.overlay as overlay
+
+
+def mode(path: Path) -> int:
+    return stat.S_IMODE(os.lstat(path).st_mode)
+
+
+@pytest.fixture
+def mount_dir(tmp_path: Path) -> Path:
+    """
+    A fake mounted image, with the symlinks found on Ubuntu images and a
+    malicious relative one.
+    """
+    root = tmp_path / "mount"
+    (root / "etc").mkdir(parents=True)
+    (root / "usr" / "bin").mkdir(parents=True)
+    (root / "run").mkdir()
+    (root / "var").mkdir()
+    (root / "bin").symlink_to("usr/bin")
+    (root / "var" / "run").symlink_to("/run")
+    (root / "etc" / "escape").symlink_to("../../outside")
+    (root / "etc" / "passwd").write_text(f"builder:x:{os.getuid()}:{os.getgid()}::/:/bin/sh\n")
+    (root / "etc" / "group").write_text(f"builder:x:{os.getgid()}:\n")
+    for d in [root, root / "etc", root / "usr", root / "usr" / "bin", root / "run"]:
+        d.chmod(0o755)
+
+    return root
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    """
+    An overlay checked out with a permissive umask.
+    """
+    src = tmp_path / "src"
+    (src / "etc").mkdir(parents=True)
+    (src / "etc" / "motd").write_text("hello\n")
+    (src / "opt" / "app").mkdir(parents=True)
+    (src / "opt" / "app" / "run.sh").write_text("#!/bin/sh\n")
+    (src / "opt" / "app" / "run.sh").chmod(0o755)
+    (src / "bin").mkdir()
+    (src / "bin" / "tool").write_text("tool\n")
+    (src / "var" / "run").mkdir(parents=True)
+    (src / "var" / "run" / "pid").write_text("1\n")
+    (src / "etc" / "escape").mkdir()
+    (src / "etc" / "escape" / "file").write_text("escaped\n")
+    (src / "etc" / "link").symlink_to("motd")
+
+    (src / "opt" / "app").chmod(0o750)
+    for d in [src, src / "etc", src / "bin", src / "opt"]:
+        d.chmod(0o775)
+
+    return src
+
+
+def check_overlay(root: Path, tmp_path: Path) -> None:
+    # existing directories of the image keep their metadata
+    assert mode(root) == 0o755
+    assert mode(root / "etc") == 0o755
+    assert mode(root / "usr" / "bin") == 0o755
+
+    # new directories get the metadata of the overlay
+    assert mode(root / "opt") == 0o775
+    assert mode(root / "opt" / "app") == 0o750
+    assert mode(root / "opt" / "app" / "run.sh") == 0o755
+
+    assert (root / "etc" / "motd").read_text() == "hello\n"
+    assert os.readlink(root / "etc" / "link") == "motd"
+
+    # symlinks of the image are followed inside the image
+    assert (root / "bin").is_symlink()
+    assert (root / "usr" / "bin" / "tool").read_text() == "tool\n"
+    assert (root / "var" / "run").is_symlink()
+    assert (root / "run" / "pid").read_text() == "1\n"
+    assert (root / "outside" / "file").read_text() == "escaped\n"
+    assert not (tmp_path / "outside").exists()
+
+
+def test_image_path(mount_dir: Path) -> None:
+    root = str(mount_dir)
+
+    assert overlay.image_path(root, "/var/run/pid") == f"{root}/run/pid"
+    assert overlay.image_path(root, "/bin/sh") == f"{root}/usr/bin/sh"
+    assert overlay.image_path(root, "/etc/escape/file") == f"{root}/outside/file"
+    assert overlay.image_path(root, "../../etc/passwd") == f"{root}/etc/passwd"
+    assert overlay.image_entry(root, "/var/run") == f"{root}/var/run"
+
+
+def test_image_path_loop(mount_dir: Path) -> None:
+    (mount_dir / "loop").symlink_to("loop")
+
+    with pytest.raises(OSError):
+        overlay.image_path(str(mount_dir), "/loop/file")
+
+
+def test_directory_overlay(mount_dir: Path, tree: Path, tmp_path: Path) -> None:
+    overlay.apply_overlay(str(mount_dir), str(tree))
+
+    check_overlay(mount_dir, tmp_path)
+
+
+def test_tarball_overlay(mount_dir: Path, tree: Path, tmp_path: Path) -> None:
+    if shutil.which("tar") is None:
+        pytest.skip("tar is not installed")
+
+    tarball = tmp_path / "overlay.tar.gz"
+    with tarfile.open(tarball, "w:gz") as tar:
+        tar.add(tree, arcname=".")
+
+    overlay.apply_overlay(str(mount_dir), str(tarball))
+
+    check_overlay(mount_dir, tmp_path)
+
+
+def test_absolute_symlink_stays_in_image(mount_dir: Path, tmp_path: Path) -> None:
+    name = f"genesis-test-{uuid.uuid4()}"
+    src = tmp_path / "src"
+    (src / "var" / "run").mkdir(parents=True)
+    (src / "var" / "run" / name).write_text("1\n")
+
+    overlay.apply_overlay(str(mount_dir), str(src))
+
+    assert (mount_dir / "run" / name).exists()
+    assert not os.path.exists(f"/run/{name}")
+
+
+def test_overlay_destination(mount_dir: Path, tree: Path) -> None:
+    overlay.apply_overlay(str(mount_dir), f"{tree / 'opt'}:/var/run/opt")
+
+    assert (mount_dir / "run" / "opt" / "app" / "run.sh").exists()
+    assert mode(mount_dir / "run" / "opt") == 0o775
+    assert mode(mount_dir / "run") == 0o755
+
+
+def test_manifest(mount_dir: Path, tmp_path: Path) -> None:
+    (mount_dir / "run" / "pid").write_text("1\n")
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside" / "file").write_text("host\n")
+    (tmp_path / "outside" / "file").chmod(0o644)
+    (mount_dir / "outside").mkdir()
+    (mount_dir / "outside" / "file").write_text("image\n")
+
+    overlay.apply_manifest(
+        str(mount_dir),
+        {
+            "/var/run/pid": {"owner": "builder", "mode": "0600"},
+            "/etc/escape/file": {"mode": 0o600},
+            "/etc": {"mode": "0750"},
+        },
+    )
+
+    assert mode(mount_dir / "run" / "pid") == 0o600
+    assert mode(mount_dir / "outside" / "file") == 0o600
+    assert mode(tmp_path / "outside" / "file") == 0o644
+    # directories named in the manifest are updated
+    assert mode(mount_dir / "etc") == 0o750
+
+
+def test_manifest_unknown_user(mount_dir: Path) -> None:
+    (mount_dir / "etc" / "motd").write_text("hello\n")
+
+    with pytest.raises(ValueError):
+        overlay.apply_manifest(str(mount_dir), {"/etc/motd": {"owner": "nobody-here"}})
@@ -0,0 +1,36 @@
+import os
+from pathlib import Path
+
+import requests
+
+import genesis.preflight as preflight
+from test_archive import create_mirror, write_release
+
+
+def test_load_suite_prunes_cache(tmp_path: Path) -> None:
+    dists = create_mirror(tmp_path / "mirror")
+    cache_dir = tmp_path / "cache"
+    mirror = f"file://{tmp_path / 'mirror'}"
+    session = requests.Session()
+
+    first = preflight.load_suite(mirror, "noble", "amd64", ["main"], session, str(cache_dir))
+    (cache_dir / "noble-updates_amd64_main_0123.json.gz").write_bytes(b"")
+    assert len(os.listdir(cache_dir)) == 2
+
+    # cached entry of the same Release file
+    assert (
+        preflight.load_suite(mirror, "noble", "amd64", ["main"], session, str(cache_dir)) == first
+    )
+    assert len(os.listdir(cache_dir)) == 2
+
+    # a new Release file replaces the entry of the suite, not the others
+    packages = (dists / "main" / "binary-amd64" / "Packages.gz").read_bytes()
+    write_release(dists, {"main/binary-amd64/Packages.gz": packages, "Contents-amd64": b""})
+    assert (
+        preflight.load_suite(mirror, "noble", "amd64", ["main"], session, str(cache_dir)) == first
+    )
+
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 2
+    assert "noble-updates_amd64_main_0123.json.gz" in entries
+    assert sum(e.startswith("noble_amd64_main_") for e in entries) == 1
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import genesis.build as build
+import genesis.telemetry as telemetry
+
+STATUS = """\
+Package: base-files
+Status: install ok installed
+Architecture: amd64
+Installed-Size: 400
+
+Package: nginx
+Status: install ok installed
+Architecture: amd64
+Installed-Size: 1200
+Description: small, powerful, scalable web/proxy server
+ Nginx ("engine X") is a high-performance web and reverse proxy server.
+
+Package: nginx-common
+Status: install ok installed
+Architecture: all
+Installed-Size: 2048
+
+Package: old-config
+Status: deinstall ok config-files
+Architecture: amd64
+Installed-Size: 10
+"""
+
+
+def test_installed_packages(tmp_path: Path) -> None:
+    (tmp_path / "var" / "lib" / "dpkg").mkdir(parents=True)
+    (tmp_path / "var" / "lib" / "dpkg" / "status").write_text(STATUS)
+
+    assert build.installed_packages(str(tmp_path)) == {
+        "base-files:amd64": 400 * 1024,
+        "nginx:amd64": 1200 * 1024,
+        "nginx-common:all": 2048 * 1024,
+    }
+
+
+def test_package_changes() -> None:
+    before = {"base-files:amd64": 400, "libc6:amd64": 1000, "removed:all": 50}
+    after = {
+        "base-files:amd64": 400,
+        "libc6:amd64": 1100,
+        "nginx:amd64": 1200,
+        "nginx-common:all": 2048,
+    }
+
+    changes = telemetry.package_changes(before, after, ["nginx=1.24.0-2"])
+
+    assert changes == [
+        {
+            "package": "nginx-common:all",
+            "requested": False,
+            "installed_size": 2048,
+            "growth": 2048,
+        },
+        {"package": "nginx:amd64", "requested": True, "installed_size": 1200, "growth": 1200},
+        {"package": "libc6:amd64", "requested": False, "installed_size": 1100, "growth": 100},
+        {"package": "removed:all", "requested": False, "installed_size": 0, "growth": -50},
+    ]